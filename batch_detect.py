@@ -0,0 +1,332 @@
+'''
+Offline batch detection
+Detects the pad tags in recorded image directories and videos and writes them to a columnar dataset
+
+A decoder thread reads the inputs in order, converts the frames to gray and hands them over in chunks through a
+bounded prefetch queue. The chunks are detected on a process pool, a bounded number of them in flight at a time, and
+their results are appended to the output in frame order as they complete. Memory use depends on the chunk size,
+prefetch and number of processes, not on the size of the dataset.
+
+With a camera file, the pose of every pad tag is solved as well, with the camera matrix of the sensor mode matching
+the frame size (frames of any other size get no poses).
+
+The output directory holds one raw little-endian binary file per column and columns.json describing them (dtype and
+shape of a row) along with the input sources. load_columns() maps them back as numpy arrays. There are two tables:
+    frames:     frame (index in the dataset), source (index into sources), position (frame number in its source, or
+                milliseconds into a video), detections (number of tags found)
+    detections: frame, id, corners (4x2 pixels), rvec, tvec (pad units, NaN without a pose), reprojection_error
+                (pixels), position_std (pad units)
+
+usage:
+    batch_detect.py [-p <pad file>[,<pad file>...]] [-c <camera file>] [-o <output dir>] [-j <processes>]
+    [-k <frames per chunk>] [-q <prefetched chunks>] <image dir, image or video>...
+
+usage example:
+    batch_detect.py -p pads/simple_pad.json -c cameras/prod_camera.json -o flight3 flight3/*.mp4
+
+default values:
+    -p: pad.json
+    -c: none (no poses)
+    -o: detections
+    -j: number of CPUs
+    -k: 16
+    -q: 4
+'''
+
+import os
+import sys
+import getopt
+import json
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import cv2 as cv
+
+# local modules
+from camera import to_gray
+from config import load_camera_config, load_pad_config, load_pad_set, detector_parameters
+from pose import tag_object_points, pose_covariance
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".pgm")
+
+# Seconds between two throughput reports
+REPORT_PERIOD = 5.0
+
+FRAME_COLUMNS = {
+    "frame": (np.int64, ()),
+    "source": (np.int32, ()),
+    "position": (np.float64, ()),
+    "detections": (np.int32, ()),
+}
+
+DETECTION_COLUMNS = {
+    "frame": (np.int64, ()),
+    "id": (np.int32, ()),
+    "corners": (np.float32, (4, 2)),
+    "rvec": (np.float64, (3,)),
+    "tvec": (np.float64, (3,)),
+    "reprojection_error": (np.float32, ()),
+    "position_std": (np.float32, ()),
+}
+
+
+def expand_inputs(inputs):
+    """
+    Sources to read, in order: the images of a directory (sorted by name), images and videos
+    """
+    sources = []
+    for path in inputs:
+        if os.path.isdir(path):
+            sources += sorted(os.path.join(path, name) for name in os.listdir(path)
+                              if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            sources.append(path)
+    return sources
+
+
+def read_frames(sources):
+    """
+    (source index, position, gray frame) of every frame of the sources
+    """
+    for source_index, path in enumerate(sources):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            frame = cv.imread(path, cv.IMREAD_GRAYSCALE)
+            if frame is None:
+                print("Failed to load", path)
+                continue
+            yield source_index, 0.0, frame
+            continue
+
+        capture = cv.VideoCapture(path)
+        if not capture.isOpened():
+            print("Failed to open", path)
+            continue
+        try:
+            while True:
+                position = capture.get(cv.CAP_PROP_POS_MSEC)
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield source_index, position, to_gray(frame)
+        finally:
+            capture.release()
+
+
+class Decoder(threading.Thread):
+    """
+    Reads the frames on its own thread and puts them in chunks on a queue of at most prefetch chunks, then None
+    """
+    def __init__(self, sources, chunk_size, prefetch):
+        super().__init__(name="decoder", daemon=True)
+        self.sources = sources
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=prefetch)
+
+    def run(self):
+        chunk = []
+        try:
+            for frame_index, (source, position, frame) in enumerate(read_frames(self.sources)):
+                chunk.append((frame_index, source, position, frame))
+                if len(chunk) == self.chunk_size:
+                    self.chunks.put(chunk)
+                    chunk = []
+            if chunk:
+                self.chunks.put(chunk)
+        finally:
+            self.chunks.put(None)
+
+
+class ColumnWriter:
+    """
+    Appends rows to the raw column files of a table
+    """
+    def __init__(self, directory, table, columns):
+        self.columns = columns
+        self.files = {name: open(os.path.join(directory, "%s.%s.bin" % (table, name)), 'wb') for name in columns}
+        self.rows = 0
+
+    def append(self, values):
+        """
+        Append the rows of a dict of column name -> array
+        """
+        for name, (dtype, shape) in self.columns.items():
+            column = np.asarray(values[name], dtype=np.dtype(dtype).newbyteorder("<"))
+            column.reshape((-1,) + shape).tofile(self.files[name])
+        self.rows += len(values["frame"])
+
+    def describe(self):
+        return {name: {"dtype": np.dtype(dtype).newbyteorder("<").str, "shape": list(shape)}
+                for name, (dtype, shape) in self.columns.items()}
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def load_columns(directory):
+    """
+    The tables of a batch_detect output as dicts of column name -> read-only memory mapped array, and the sources
+    """
+    with open(os.path.join(directory, "columns.json"), 'r') as f:
+        description = json.loads(f.read())
+    tables = {}
+    for table, columns in description["tables"].items():
+        tables[table] = {}
+        for name, column in columns.items():
+            path = os.path.join(directory, "%s.%s.bin" % (table, name))
+            shape = (description["rows"][table],) + tuple(column["shape"])
+            tables[table][name] = np.memmap(path, dtype=column["dtype"], mode='r', shape=shape) \
+                if shape[0] > 0 else np.empty(shape, dtype=column["dtype"])
+    return tables, description["sources"]
+
+
+# Per-process state, set once by the pool initializer instead of being sent with every chunk
+_detector = None
+_pad_set = None
+_camera_config = None
+
+
+def _init_worker(pad_files, camera_file):
+    global _detector, _pad_set, _camera_config
+    # One thread per process, the pool provides the parallelism
+    cv.setNumThreads(1)
+    _pad_set = load_pad_set([load_pad_config(pad_file) for pad_file in pad_files])
+    _detector = cv.aruco.ArucoDetector(_pad_set.dictionary, detector_parameters(_pad_set.detector_parameters))
+    _camera_config = load_camera_config(camera_file) if camera_file else None
+
+
+def camera_matrix(camera_config, shape):
+    """
+    Camera matrix of the sensor mode of the given frame shape, None if no mode has that size
+    """
+    for mode, cam_matrix in zip(camera_config.modes, camera_config.mode_matrices):
+        if (int(mode["height"]), int(mode["width"])) == shape:
+            return cam_matrix
+    return None
+
+
+def detect_chunk(chunk):
+    """
+    Detect the tags of a chunk of frames, returns the rows of the frames and detections tables
+    """
+    frames = {name: [] for name in FRAME_COLUMNS}
+    detections = {name: [] for name in DETECTION_COLUMNS}
+    for frame_index, source, position, gray in chunk:
+        corners, ids, _rejected = _detector.detectMarkers(gray)
+        ids = np.ravel(ids) if ids is not None else np.empty(0, dtype=np.int32)
+        if _pad_set.id_map is not None:
+            ids = _pad_set.id_map[ids]
+
+        frames["frame"].append(frame_index)
+        frames["source"].append(source)
+        frames["position"].append(position)
+        frames["detections"].append(len(ids))
+
+        cam_matrix = camera_matrix(_camera_config, gray.shape) if _camera_config is not None else None
+        for tag_id, tag_corners in zip(ids, corners):
+            rvec = tvec = np.full(3, np.nan)
+            error = std = np.nan
+            tag = _pad_set.tags.get(str(tag_id))
+            if cam_matrix is not None and tag is not None:
+                obj_points = tag_object_points(tag[0])
+                ok, rvec, tvec = cv.solvePnP(obj_points, tag_corners, cam_matrix, _camera_config.dist_coefficients,
+                                             flags=cv.SOLVEPNP_IPPE_SQUARE)
+                error, covariance = pose_covariance(obj_points, tag_corners, rvec, tvec, cam_matrix,
+                                                    _camera_config.dist_coefficients)
+                std = np.sqrt(np.trace(covariance[3:, 3:]))
+
+            detections["frame"].append(frame_index)
+            detections["id"].append(tag_id)
+            detections["corners"].append(np.reshape(tag_corners, (4, 2)))
+            detections["rvec"].append(np.ravel(rvec))
+            detections["tvec"].append(np.ravel(tvec))
+            detections["reprojection_error"].append(error)
+            detections["position_std"].append(std)
+    return frames, detections
+
+
+def main():
+    args, inputs = getopt.getopt(sys.argv[1:], 'p:c:o:j:k:q:', [])
+    args = dict(args)
+    args.setdefault('-p', 'pad.json')
+    args.setdefault('-c', '')
+    args.setdefault('-o', 'detections')
+    args.setdefault('-j', os.cpu_count() or 1)
+    args.setdefault('-k', 16)
+    args.setdefault('-q', 4)
+
+    pad_files = str(args.get('-p')).split(',')
+    camera_file = str(args.get('-c'))
+    output_dir = str(args.get('-o'))
+    processes = int(args.get('-j'))
+    chunk_size = int(args.get('-k'))
+    prefetch = int(args.get('-q'))
+
+    # Fail early on bad configuration files rather than in every process
+    try:
+        load_pad_set([load_pad_config(pad_file) for pad_file in pad_files])
+        if camera_file:
+            load_camera_config(camera_file)
+    except (OSError, ValueError) as e:
+        print(e)
+        return
+
+    sources = expand_inputs(inputs)
+    if len(sources) == 0:
+        print("No input")
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    frame_writer = ColumnWriter(output_dir, "frames", FRAME_COLUMNS)
+    detection_writer = ColumnWriter(output_dir, "detections", DETECTION_COLUMNS)
+
+    decoder = Decoder(sources, chunk_size, prefetch)
+    decoder.start()
+
+    start = last_report = time.monotonic()
+    reported_frames = 0
+    with Pool(processes, _init_worker, (pad_files, camera_file)) as pool:
+        # Chunks in flight, oldest first, so results are written in frame order
+        pending = deque()
+        decoding = True
+        while decoding or pending:
+            while decoding and len(pending) < 2 * processes:
+                chunk = decoder.chunks.get()
+                if chunk is None:
+                    decoding = False
+                else:
+                    pending.append(pool.apply_async(detect_chunk, (chunk,)))
+            if not pending:
+                break
+
+            frames, detections = pending.popleft().get()
+            frame_writer.append(frames)
+            detection_writer.append(detections)
+
+            now = time.monotonic()
+            if now - last_report > REPORT_PERIOD:
+                print("%d frames, %.1f fps (%.1f fps overall), %d detections" % (
+                    frame_writer.rows, (frame_writer.rows - reported_frames) / (now - last_report),
+                    frame_writer.rows / (now - start), detection_writer.rows))
+                last_report, reported_frames = now, frame_writer.rows
+
+    frame_writer.close()
+    detection_writer.close()
+    with open(os.path.join(output_dir, "columns.json"), 'w') as f:
+        f.write(json.dumps({"sources": sources,
+                            "rows": {"frames": frame_writer.rows, "detections": detection_writer.rows},
+                            "tables": {"frames": frame_writer.describe(),
+                                       "detections": detection_writer.describe()}}, indent=2))
+
+    elapsed = time.monotonic() - start
+    print("%d frames from %d sources in %.1f s, %.1f fps, %d detections written to %s" % (
+        frame_writer.rows, len(sources), elapsed, frame_writer.rows / max(elapsed, 1e-9), detection_writer.rows,
+        output_dir))
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    main()
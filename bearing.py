@@ -0,0 +1,73 @@
+'''
+Bearing-only targeting
+Line of sight to a tag from its corners and the camera intrinsics, without solving its pose
+
+A tag only a few pixels wide at altitude gives no usable pose, but its center still gives the direction of the
+target. The center is the intersection of the tag diagonals (the exact projection of the square's center), which
+is undistorted to normalized camera coordinates and rotated through the camera offset like the positions are. The
+autopilot gets the direction as LANDING_TARGET angles and the distance from its own rangefinder. Full position mode
+takes over once the tag is large enough to solve its pose reliably.
+'''
+
+import math
+import numpy as np
+import cv2 as cv
+
+
+def tag_center(corners):
+    """
+    Image of the tag center, the intersection of its diagonals
+    """
+    p = np.hstack([np.reshape(corners, (4, 2)).astype(np.float64), np.ones((4, 1))])
+    center = np.cross(np.cross(p[0], p[2]), np.cross(p[1], p[3]))
+    return center[:2] / center[2]
+
+
+def tag_bearing(corners, cam_matrix, dist_coefficients):
+    """
+    Unit line of sight to the tag center in the camera frame
+    """
+    center = tag_center(corners).reshape(1, 1, 2)
+    x, y = cv.undistortPoints(center, cam_matrix, dist_coefficients).ravel()
+    direction = np.array([x, y, 1.0])
+    return direction / np.linalg.norm(direction)
+
+
+def landing_target_angles(bearing):
+    """
+    LANDING_TARGET angle_x and angle_y (radians) of a bearing rotated through the camera offset.
+
+    Positions are sent as forward = -x, right = -y, down = z, and ArduPilot rebuilds the body frame line of sight
+    from the angles as (-tan(angle_y), tan(angle_x), 1).
+    """
+    forward, right, down = -bearing[0], -bearing[1], bearing[2]
+    return math.atan2(right, down), math.atan2(-forward, down)
+
+
+def tag_size(corners):
+    """
+    Longest side of a tag, in pixels
+    """
+    quad = np.reshape(corners, (4, 2))
+    return float(np.linalg.norm(quad - np.roll(quad, 1, axis=0), axis=1).max())
+
+
+class PositionModeSwitch:
+    """
+    Full position mode once the tag is at least min_tag_size pixels, bearing-only mode once it falls hysteresis
+    below that. A min_tag_size of 0 always uses position mode.
+    """
+    def __init__(self, min_tag_size=0.0, hysteresis=0.2):
+        self.min_tag_size = min_tag_size
+        self.hysteresis = hysteresis
+        self.position_mode = False
+
+    def update(self, size):
+        """
+        Returns True if the pose of a tag of the given size should be solved
+        """
+        if size >= self.min_tag_size:
+            self.position_mode = True
+        elif size < self.min_tag_size * (1 - self.hysteresis):
+            self.position_mode = False
+        return self.position_mode
@@ -0,0 +1,241 @@
+'''
+Hot path benchmarks
+Times the per-frame steps of the detection loop and compares them with the baseline stored for this machine
+
+Covered: rotate_vector_3d, compute_position with 1 to 20 tags, detectMarkers on images/cam.jpg and on synthetic
+frames at several resolutions, the conversion of captured frames to gray, and the packing of a LANDING_TARGET message.
+Every benchmark is warmed up, then timed over several rounds of enough calls to last at least 10 ms each. The fastest
+round is the figure compared against the baseline, as it is the one least disturbed by the rest of the system.
+
+Baselines are per machine, in <baseline dir>/<machine>.json. The first run on a machine writes its baseline, later
+runs exit with status 1 if any benchmark got slower than the baseline by more than the threshold. -u overwrites the
+baseline with the current timings, after an intended slowdown or a faster implementation.
+
+usage:
+    benchmark.py [-p <pad file>] [-b <baseline dir>] [-m <machine name>] [-t <threshold>] [-r <rounds>]
+    [-k <name filter>] [-u]
+
+usage example:
+    benchmark.py -k detect -t 0.1
+
+default values:
+    -p: pads/simple_pad.json
+    -b: benchmarks
+    -m: host name
+    -t: 0.2 (20% slower fails)
+    -r: 7
+    -k: every benchmark
+'''
+
+import os
+import sys
+import getopt
+import json
+import platform
+import time
+import numpy as np
+import cv2 as cv
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+# local modules
+from camera import to_gray
+from config import load_pad_config, load_pad_set
+from pose import PoseEstimator, tag_object_points
+from main import rotate_vector_3d, compute_position, create_detector, detect_markers
+
+# Resolutions of the synthetic frames, up to the full sensor
+SYNTHETIC_RESOLUTIONS = [(640, 480), (1280, 960), (1600, 1300), (2028, 1520)]
+
+TAG_COUNTS = [1, 5, 10, 20]
+
+# Calls before timing, and minimum duration (seconds) of a timed round
+WARMUP_CALLS = 5
+MIN_ROUND_TIME = 0.01
+
+CAM_MATRIX = np.array([[1400.0, 0, 800], [0, 1400.0, 650], [0, 0, 1]])
+DIST_COEFFICIENTS = np.zeros(5)
+CAMERA_OFFSET = [[0.05, 0.0, 0.02], [0.0, 0.0, np.pi / 2]]
+
+
+def time_call(function, rounds):
+    """
+    Seconds per call of function, as the (fastest, median) of rounds timed rounds
+    """
+    for _ in range(WARMUP_CALLS):
+        function()
+
+    # Calls per round, doubled until a round lasts long enough for the clock resolution not to matter
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        if time.perf_counter() - start >= MIN_ROUND_TIME:
+            break
+        calls *= 2
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        timings.append((time.perf_counter() - start) / calls)
+    return min(timings), float(np.median(timings))
+
+
+def synthetic_frame(dictionary, size, tag_count=3):
+    """
+    Gray frame of the given (width, height) holding tag_count markers of the dictionary, a tenth of its height wide
+    """
+    w, h = size
+    rng = np.random.default_rng(0)
+    frame = cv.resize(rng.integers(60, 200, (h // 40, w // 40), dtype=np.uint8), (w, h), interpolation=cv.INTER_CUBIC)
+    side = h // 10
+    for index in range(tag_count):
+        x = (index + 1) * w // (tag_count + 1) - side // 2
+        y = h // 2 - side // 2
+        marker = cv.aruco.generateImageMarker(dictionary, index, side)
+        frame[y - side // 5:y + side + side // 5, x - side // 5:x + side + side // 5] = 255
+        frame[y:y + side, x:x + side] = marker
+    return frame
+
+
+def synthetic_pad(tag_count):
+    """
+    Pad tags dict and the projected corners of tag_count tags of a 3 m away pad, tag 0 being the payload
+    """
+    pad_tags = {}
+    corners = []
+    for tag_id in range(tag_count):
+        position = [200.0 * (tag_id % 5), 200.0 * (tag_id // 5), 0.0]
+        pad_tags[str(tag_id)] = [100.0, position]
+        points, _ = cv.projectPoints(tag_object_points(100.0), np.array([0.2, -0.1, 0.05]),
+                                     np.array([position[0] - 400, position[1] - 300, 3000.0]),
+                                     CAM_MATRIX, DIST_COEFFICIENTS)
+        corners.append(points.reshape(1, 4, 2).astype(np.float32))
+    ids = np.arange(tag_count, dtype=np.int32).reshape(-1, 1)
+    return pad_tags, tuple(corners), ids
+
+
+def benchmarks(pad_set):
+    """
+    (name, function) of every benchmark
+    """
+    cases = [("rotate_vector_3d", lambda: rotate_vector_3d(np.array([0.3, -0.2, 3.0]), CAMERA_OFFSET[1]))]
+
+    for tag_count in TAG_COUNTS:
+        pad_tags, corners, ids = synthetic_pad(tag_count)
+        # Warm pose estimator, as in flight where every tag continues its track
+        pose_estimator = PoseEstimator()
+        cases.append(("compute_position[%d tags]" % tag_count,
+                      lambda pad_tags=pad_tags, corners=corners, ids=ids, pose_estimator=pose_estimator:
+                      compute_position(corners, ids, pad_tags, 0, CAMERA_OFFSET, CAM_MATRIX, DIST_COEFFICIENTS,
+                                       pose_estimator, 0.0)))
+
+    detector = create_detector(pad_set)
+    cam_image = cv.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), "images", "cam.jpg"))
+    if cam_image is not None:
+        cam_gray = to_gray(cam_image)
+        cases.append(("detectMarkers[cam.jpg]", lambda: detect_markers(detector, cam_gray)))
+    else:
+        print("images/cam.jpg not found, skipping its benchmark")
+
+    # Draw the markers from the detector's own dictionary, so they are found whether or not it is restricted
+    for size in SYNTHETIC_RESOLUTIONS:
+        gray = synthetic_frame(pad_set.dictionary, size, min(3, pad_set.dictionary.bytesList.shape[0]))
+        cases.append(("detectMarkers[%dx%d]" % size, lambda gray=gray: detect_markers(detector, gray)))
+
+    for size in SYNTHETIC_RESOLUTIONS:
+        # Picamera2 delivers BGRA frames
+        frame = cv.cvtColor(synthetic_frame(pad_set.dictionary, size, 0), cv.COLOR_GRAY2BGRA)
+        cases.append(("to_gray[%dx%d]" % size, lambda frame=frame: to_gray(frame)))
+
+    mav = mavlink.MAVLink(None, srcSystem=1, srcComponent=197)
+    cases.append(("landing_target pack",
+                  lambda: mavlink.MAVLink_landing_target_message(
+                      int(time.time() * 1000000), 0, mavlink.MAV_FRAME_BODY_NED, 0, 0, 0, 0, 0,
+                      0.1, -0.2, 3.0, [0, 0, 0, 1], 0, 1).pack(mav)))
+    return cases
+
+
+def machine_info():
+    return {"machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv.__version__}
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return "%8.2f us" % (1e6 * seconds)
+    return "%8.2f ms" % (1e3 * seconds)
+
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], 'p:b:m:t:r:k:u', [])
+    args = dict(args)
+    args.setdefault('-p', 'pads/simple_pad.json')
+    args.setdefault('-b', 'benchmarks')
+    args.setdefault('-m', platform.node() or "default")
+    args.setdefault('-t', 0.2)
+    args.setdefault('-r', 7)
+    args.setdefault('-k', '')
+
+    baseline_file = os.path.join(str(args.get('-b')), str(args.get('-m')) + ".json")
+    threshold = float(args.get('-t'))
+    rounds = int(args.get('-r'))
+    name_filter = str(args.get('-k'))
+    update = '-u' in args
+
+    pad_set = load_pad_set([load_pad_config(str(args.get('-p')))])
+
+    baseline = None
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.loads(f.read())
+        if baseline["info"] != machine_info():
+            print("Baseline recorded with %s, now running %s" % (baseline["info"], machine_info()))
+
+    results = {}
+    regressions = []
+    print("%-28s %11s %11s %11s %8s" % ("benchmark", "fastest", "median", "baseline", "change"))
+    for name, function in benchmarks(pad_set):
+        if name_filter not in name:
+            continue
+        fastest, median = time_call(function, rounds)
+        results[name] = {"fastest": fastest, "median": median}
+
+        reference = baseline["results"].get(name) if baseline is not None else None
+        if reference is None:
+            print("%-28s %s %s" % (name, format_time(fastest), format_time(median)))
+            continue
+        change = fastest / reference["fastest"] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("%-28s %s %s %s %+7.1f%%%s" % (name, format_time(fastest), format_time(median),
+                                           format_time(reference["fastest"]), 100 * change,
+                                           "  REGRESSION" if regressed else ""))
+
+    if baseline is None or update:
+        # Keep the benchmarks that were filtered out of this run
+        merged = dict(baseline["results"]) if baseline is not None else {}
+        merged.update(results)
+        os.makedirs(os.path.dirname(baseline_file) or ".", exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            f.write(json.dumps({"info": machine_info(), "results": merged}, indent=2))
+        print("\nBaseline written to %s" % baseline_file)
+        return 0
+
+    if regressions:
+        print("\n%d benchmark(s) more than %.0f%% slower than the baseline: %s" % (
+            len(regressions), 100 * threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    sys.exit(main())
@@ -35,7 +35,7 @@ import cv2 as cv
 import json
 
 # local modules
-from common import splitfn
+from common import splitfn, aruco_dicts, get_aruco_dictionary
 
 # built-in modules
 import os
@@ -84,34 +84,11 @@ def main():
     img_points = []
     h, w = cv.imread(img_names[0], cv.IMREAD_GRAYSCALE).shape[:2]  # TODO: use imquery call to retrieve results
 
-    aruco_dicts = {
-        'DICT_4X4_50': cv.aruco.DICT_4X4_50,
-        'DICT_4X4_100': cv.aruco.DICT_4X4_100,
-        'DICT_4X4_250': cv.aruco.DICT_4X4_250,
-        'DICT_4X4_1000': cv.aruco.DICT_4X4_1000,
-        'DICT_5X5_50': cv.aruco.DICT_5X5_50,
-        'DICT_5X5_100': cv.aruco.DICT_5X5_100,
-        'DICT_5X5_250': cv.aruco.DICT_5X5_250,
-        'DICT_5X5_1000': cv.aruco.DICT_5X5_1000,
-        'DICT_6X6_50': cv.aruco.DICT_6X6_50,
-        'DICT_6X6_100': cv.aruco.DICT_6X6_100,
-        'DICT_6X6_250': cv.aruco.DICT_6X6_250,
-        'DICT_6X6_1000': cv.aruco.DICT_6X6_1000,
-        'DICT_7X7_50': cv.aruco.DICT_7X7_50,
-        'DICT_7X7_100': cv.aruco.DICT_7X7_100,
-        'DICT_7X7_250': cv.aruco.DICT_7X7_250,
-        'DICT_7X7_1000': cv.aruco.DICT_7X7_1000,
-        'DICT_ARUCO_ORIGINAL': cv.aruco.DICT_ARUCO_ORIGINAL,
-        'DICT_APRILTAG_16h5': cv.aruco.DICT_APRILTAG_16h5,
-        'DICT_APRILTAG_25h9': cv.aruco.DICT_APRILTAG_25h9,
-        'DICT_APRILTAG_36h10': cv.aruco.DICT_APRILTAG_36h10,
-        'DICT_APRILTAG_36h11': cv.aruco.DICT_APRILTAG_36h11
-    }
 
     if (aruco_dict_name not in set(aruco_dicts.keys())):
         print("unknown aruco dictionary name")
         return None
-    aruco_dict = cv.aruco.getPredefinedDictionary(aruco_dicts[aruco_dict_name])
+    aruco_dict = get_aruco_dictionary(aruco_dict_name)
     board = cv.aruco.CharucoBoard(pattern_size, square_size, marker_size, aruco_dict)
     charuco_detector = cv.aruco.CharucoDetector(board)
 
@@ -0,0 +1,178 @@
+'''
+Camera capture
+Opens the camera described by a camera file and hands out monochrome frames
+
+The "capture_method" key of the camera file selects OpenCV or the Raspberry Pi camera stack. The optional
+"device" key selects which camera to open when several are attached (0 by default).
+
+The optional "sensor_modes" key lists the capture modes the camera can switch between, finest first:
+    {"binning": 2, "crop": [0, 0], "height": 650, "min_tag_size": 200, "width": 800}
+binning and crop relate the mode's pixels to the full resolution (camera_width x camera_height) pixels the camera
+was calibrated at, and min_tag_size is the apparent tag side (in full resolution pixels) above which the mode
+is used.
+'''
+
+import time
+import numpy as np
+import cv2 as cv
+
+
+class Camera:
+    """
+    Thin wrapper giving the OpenCV and Picamera2 capture paths the same read()/close() interface.
+    """
+    def __init__(self, camera_params):
+        self.params = camera_params
+        self.capture_method = camera_params["capture_method"]
+        device = int(camera_params.get("device", 0))
+        self.mode = sensor_modes(camera_params)[0]
+
+        if self.capture_method == "OpenCV":
+            # Create OpenCV cam
+            self.cam = cv.VideoCapture(device)
+
+        elif self.capture_method == "PiCamera":
+            from picamera2 import Picamera2
+            # Create pi camera
+            self.cam = Picamera2(device)
+        else:
+            raise ValueError("Invalid Camera capture method: %s" % self.capture_method)
+
+        self._configure(self.mode)
+
+    def _configure(self, mode):
+        size = (mode["width"], mode["height"])
+        if self.capture_method == "OpenCV":
+            # set OpenCV camera params
+            self.cam.set(cv.CAP_PROP_FRAME_WIDTH, size[0])
+            self.cam.set(cv.CAP_PROP_FRAME_HEIGHT, size[1])
+        else:
+            binning = mode.get("binning", 1)
+            crop_x, crop_y = mode.get("crop", [0, 0])
+            controls = {}
+            if crop_x or crop_y:
+                controls["ScalerCrop"] = (crop_x, crop_y, size[0] * binning, size[1] * binning)
+            self.cam.configure(self.cam.create_preview_configuration(
+                main={"size": size}, sensor={"output_size": size}, controls=controls))
+            self.cam.start()
+
+    def set_mode(self, mode):
+        """
+        Switch to another sensor mode, returns the time the switch took in seconds
+        """
+        start = time.monotonic()
+        if self.capture_method == "PiCamera":
+            self.cam.stop()
+        self._configure(mode)
+        self.mode = mode
+        return time.monotonic() - start
+
+    def read(self):
+        """
+        Capture a frame, returns None if the camera did not deliver one
+        """
+        if self.capture_method == "OpenCV":
+            ret, frame = self.cam.read()
+            return frame if ret else None
+        return self.cam.capture_array()
+
+    def set_controls(self, controls):
+        """
+        Apply libcamera controls (ExposureTime, AnalogueGain, ...), ignored by the OpenCV capture method
+        """
+        if self.capture_method == "PiCamera":
+            self.cam.set_controls(controls)
+
+    def close(self):
+        if self.capture_method == "OpenCV":
+            self.cam.release()
+        else:
+            self.cam.stop()
+            self.cam.close()
+
+
+def to_gray(frame):
+    """
+    Make a captured frame monochrome, whatever the number of channels the capture method delivers
+    """
+    if frame.ndim == 2:
+        return frame
+    if frame.shape[2] == 4:
+        return cv.cvtColor(frame, cv.COLOR_BGRA2GRAY)
+    return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+
+def sensor_modes(camera_params):
+    """
+    The sensor modes declared in the camera file, or the calibration resolution alone if there are none
+    """
+    return camera_params.get("sensor_modes", [{"binning": 1,
+                                               "crop": [0, 0],
+                                               "height": camera_params["camera_height"],
+                                               "width": camera_params["camera_width"]}])
+
+
+def scale_camera_matrix(cam_matrix, mode):
+    """
+    Camera matrix of a sensor mode, from the matrix calibrated at full resolution.
+
+    The mode's pixel (u, v) covers the full resolution pixels starting at crop + binning * (u, v), so focal lengths
+    are divided by the binning and the principal point is shifted by the crop before being scaled (pixel centers
+    being at half pixels). Distortion coefficients apply to normalized coordinates and stay valid as they are.
+    """
+    binning = float(mode.get("binning", 1))
+    crop_x, crop_y = mode.get("crop", [0, 0])
+    scaled = np.array(cam_matrix, dtype=np.float64)
+    scaled[0, :2] /= binning
+    scaled[1, 1] /= binning
+    scaled[0, 2] = (scaled[0, 2] - crop_x + 0.5) / binning - 0.5
+    scaled[1, 2] = (scaled[1, 2] - crop_y + 0.5) / binning - 0.5
+    return scaled
+
+
+class ModeSelector:
+    """
+    Picks the sensor mode from the apparent size of the tags.
+
+    The coarsest mode whose min_tag_size the tags exceed is used. Switching to a coarser mode needs the tags to be
+    hysteresis larger than its min_tag_size, and the finest mode is restored once no tag has been seen for
+    lost_frames frames, so far away tags can be acquired again.
+    """
+    def __init__(self, modes, hysteresis=0.2, lost_frames=15):
+        self.modes = modes
+        self.hysteresis = hysteresis
+        self.lost_frames = lost_frames
+        self.current = 0
+        self.frames_without_tag = 0
+
+    def update(self, corners):
+        """
+        Returns the index of the mode to switch to, or None to stay in the current one
+        """
+        if corners is None or len(corners) == 0:
+            self.frames_without_tag += 1
+            if self.current != 0 and self.frames_without_tag >= self.lost_frames:
+                return self._switch(0)
+            return None
+        self.frames_without_tag = 0
+
+        # Largest tag side, in full resolution pixels
+        quads = np.reshape(np.concatenate([np.reshape(c, (-1, 2)) for c in corners]), (-1, 4, 2))
+        sides = np.linalg.norm(quads - np.roll(quads, 1, axis=1), axis=2)
+        tag_size = sides.max() * self.modes[self.current].get("binning", 1)
+
+        target = self.current
+        while target + 1 < len(self.modes) and \
+                tag_size >= self.modes[target + 1].get("min_tag_size", 0) * (1 + self.hysteresis):
+            target += 1
+        while target > 0 and tag_size < self.modes[target].get("min_tag_size", 0):
+            target -= 1
+
+        if target == self.current:
+            return None
+        return self._switch(target)
+
+    def _switch(self, index):
+        self.current = index
+        self.frames_without_tag = 0
+        return index
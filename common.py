@@ -22,6 +22,64 @@ from contextlib import contextmanager
 
 image_extensions = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.pbm', '.pgm', '.ppm']
 
+aruco_dicts = {
+    'DICT_4X4_50': cv.aruco.DICT_4X4_50,
+    'DICT_4X4_100': cv.aruco.DICT_4X4_100,
+    'DICT_4X4_250': cv.aruco.DICT_4X4_250,
+    'DICT_4X4_1000': cv.aruco.DICT_4X4_1000,
+    'DICT_5X5_50': cv.aruco.DICT_5X5_50,
+    'DICT_5X5_100': cv.aruco.DICT_5X5_100,
+    'DICT_5X5_250': cv.aruco.DICT_5X5_250,
+    'DICT_5X5_1000': cv.aruco.DICT_5X5_1000,
+    'DICT_6X6_50': cv.aruco.DICT_6X6_50,
+    'DICT_6X6_100': cv.aruco.DICT_6X6_100,
+    'DICT_6X6_250': cv.aruco.DICT_6X6_250,
+    'DICT_6X6_1000': cv.aruco.DICT_6X6_1000,
+    'DICT_7X7_50': cv.aruco.DICT_7X7_50,
+    'DICT_7X7_100': cv.aruco.DICT_7X7_100,
+    'DICT_7X7_250': cv.aruco.DICT_7X7_250,
+    'DICT_7X7_1000': cv.aruco.DICT_7X7_1000,
+    'DICT_ARUCO_ORIGINAL': cv.aruco.DICT_ARUCO_ORIGINAL,
+    'DICT_APRILTAG_16h5': cv.aruco.DICT_APRILTAG_16h5,
+    'DICT_APRILTAG_25h9': cv.aruco.DICT_APRILTAG_25h9,
+    'DICT_APRILTAG_36h10': cv.aruco.DICT_APRILTAG_36h10,
+    'DICT_APRILTAG_36h11': cv.aruco.DICT_APRILTAG_36h11
+}
+
+def get_aruco_dictionary(name):
+    '''Return the predefined aruco dictionary called name, raising KeyError if unknown'''
+    if name not in aruco_dicts:
+        raise KeyError("unknown aruco dictionary name: %s" % name)
+    return cv.aruco.getPredefinedDictionary(aruco_dicts[name])
+
+def marker_distance(dictionary, ids):
+    '''Minimum hamming distance between the given markers, over all rotations.
+
+    A marker is also compared against its own 90, 180 and 270 degree rotations,
+    since those are what the detector has to tell apart to recover the orientation.
+    '''
+    bits = [cv.aruco.Dictionary.getBitsFromByteList(dictionary.bytesList[i:i+1], dictionary.markerSize)
+            for i in ids]
+    tau = dictionary.markerSize * dictionary.markerSize
+    for i, a in enumerate(bits):
+        for r in range(1, 4):
+            tau = min(tau, int(np.count_nonzero(a != np.rot90(a, r))))
+        for b in bits[i+1:]:
+            for r in range(4):
+                tau = min(tau, int(np.count_nonzero(a != np.rot90(b, r))))
+    return tau
+
+def restricted_dictionary(dictionary, ids):
+    '''Build a dictionary holding only the given marker ids of dictionary.
+
+    Marker i of the returned dictionary is ids[i] of the original one, so detected
+    ids have to be mapped back through ids. The correction bits are raised to what
+    the reduced set can tolerate.
+    '''
+    ids = [int(i) for i in ids]
+    max_correction_bits = max(0, (marker_distance(dictionary, ids) - 1) // 2)
+    return cv.aruco.Dictionary(dictionary.bytesList[ids], dictionary.markerSize, max_correction_bits)
+
 class Bunch(object):
     def __init__(self, **kw):
         self.__dict__.update(kw)
@@ -59,6 +117,21 @@ def rect2rect_mtx(src, dst):
                     [  0,  0,  1]])
     return M
 
+def tag_bounds(corners, margin, shape):
+    '''Bounding box (x0, y0, x1, y1) of the tag corners grown by margin times its size, clipped to an
+    image of the given shape. None if there are no corners or the box is empty.'''
+    if corners is None or len(corners) == 0:
+        return None
+    points = np.concatenate([np.reshape(c, (-1, 2)) for c in corners])
+    x0, y0 = points.min(0)
+    x1, y1 = points.max(0)
+    mx, my = margin * (x1 - x0), margin * (y1 - y0)
+    h, w = shape[:2]
+    x0, y0 = int(max(x0 - mx, 0)), int(max(y0 - my, 0))
+    x1, y1 = int(min(x1 + mx + 1, w)), int(min(y1 + my + 1, h))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
 
 def lookat(eye, target, up = (0, 0, 1)):
     fwd = np.asarray(target, np.float64) - eye
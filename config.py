@@ -0,0 +1,247 @@
+'''
+Configuration loading
+Validates and precompiles camera and pad files, and reloads them when they change on disk
+
+Loading a file checks its contents and computes everything the detection loop needs from it (camera matrices of
+every sensor mode, restricted aruco dictionary, detector parameters), so a new configuration can be swapped in
+between two frames. Several pads are detected together as a pad set, sharing a single dictionary.
+ConfigWatcher polls the modification times of the files and publishes every configuration that loads cleanly,
+a bad edit is reported and the running configuration is kept.
+'''
+
+import os
+import json
+import threading
+import time
+import numpy as np
+import cv2 as cv
+
+# local modules
+from common import Bunch, get_aruco_dictionary, restricted_dictionary
+from camera import sensor_modes, scale_camera_matrix
+
+CAPTURE_METHODS = ("OpenCV", "PiCamera")
+
+# Number of distortion coefficients OpenCV accepts
+DISTORTION_SIZES = (4, 5, 8, 12, 14)
+
+
+def read_json(path):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+
+def load_camera_config(path):
+    """
+    Read and validate a camera file, raises ValueError if it is not usable
+    """
+    try:
+        params = read_json(path)
+        if params["capture_method"] not in CAPTURE_METHODS:
+            raise ValueError("Invalid Camera capture method: %s" % params["capture_method"])
+        if int(params["camera_width"]) <= 0 or int(params["camera_height"]) <= 0:
+            raise ValueError("camera size must be positive")
+
+        cam_matrix = np.array(params["calibration"][0], dtype=np.float64)
+        dist_coefficients = np.array(params["calibration"][1], dtype=np.float64)
+        if cam_matrix.shape != (3, 3) or not np.isfinite(cam_matrix).all() or \
+                cam_matrix[0, 0] <= 0 or cam_matrix[1, 1] <= 0:
+            raise ValueError("calibration camera matrix must be a finite 3x3 matrix")
+        if dist_coefficients.size not in DISTORTION_SIZES or not np.isfinite(dist_coefficients).all():
+            raise ValueError("calibration needs %s distortion coefficients" % (DISTORTION_SIZES,))
+
+        camera_offset = np.array(params["camera_offset"], dtype=np.float64)
+        if camera_offset.shape != (2, 3) or not np.isfinite(camera_offset).all():
+            raise ValueError("camera_offset must be a position and a rotation of 3 values each")
+
+        modes = sensor_modes(params)
+        for mode in modes:
+            if int(mode["width"]) <= 0 or int(mode["height"]) <= 0 or mode.get("binning", 1) < 1:
+                raise ValueError("invalid sensor mode: %s" % mode)
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError("malformed camera file %s: %r" % (path, e))
+
+    return Bunch(path=path,
+                 params=params,
+                 cam_matrix=cam_matrix,
+                 dist_coefficients=dist_coefficients,
+                 camera_offset=params["camera_offset"],
+                 modes=modes,
+                 mode_matrices=[scale_camera_matrix(cam_matrix, mode) for mode in modes])
+
+
+def pad_dictionary(pad_params):
+    """
+    The aruco dictionary described by the pad file.
+
+    The dictionary family is taken from the optional "aruco_dict" key (DICT_4X4_50 by default). When "restrict_dict"
+    is set, the dictionary only holds the IDs used by the pad, which is cheaper to decode, rejects more false
+    candidates and allows more error correction bits. Detected IDs are then indices into the reduced dictionary and
+    have to be mapped back through the returned id_map, which is None for a full dictionary.
+    """
+    aruco_dict = get_aruco_dictionary(pad_params.get("aruco_dict", "DICT_4X4_50"))
+    id_map = None
+
+    if pad_params.get("restrict_dict", False):
+        pad_ids = set(int(tag_id) for tag_id in pad_params["pad_tags"])
+        pad_ids.add(int(pad_params["payload_tag_ID"]))
+        id_map = np.array(sorted(pad_ids), dtype=np.int32)
+        aruco_dict = restricted_dictionary(aruco_dict, id_map)
+
+    return aruco_dict, id_map
+
+
+def detector_parameters(values):
+    """
+    aruco DetectorParameters with the given attributes set, raises ValueError on unknown attributes
+    """
+    parameters = cv.aruco.DetectorParameters()
+    for name, value in values.items():
+        if name.startswith("_") or not hasattr(parameters, name):
+            raise ValueError("unknown detector parameter: %s" % name)
+        setattr(parameters, name, type(getattr(parameters, name))(value))
+    return parameters
+
+
+def load_pad_config(path):
+    """
+    Read and validate a pad file, raises ValueError if it is not usable
+    """
+    try:
+        params = read_json(path)
+        pad_tags = params["pad_tags"]
+        payload_tag_ID = int(params["payload_tag_ID"])
+        dictionary_size = get_aruco_dictionary(params.get("aruco_dict", "DICT_4X4_50")).bytesList.shape[0]
+
+        for tag_id, (size, position) in pad_tags.items():
+            if not 0 <= int(tag_id) < dictionary_size:
+                raise ValueError("tag %s is not in the dictionary" % tag_id)
+            if not float(size) > 0 or len(position) != 3:
+                raise ValueError("tag %s needs a positive size and a 3D position" % tag_id)
+        if str(payload_tag_ID) not in pad_tags:
+            raise ValueError("payload tag %d is not one of the pad tags" % payload_tag_ID)
+
+        dictionary, id_map = pad_dictionary(params)
+        detector_parameters(params.get("detector_parameters", {}))
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError("malformed pad file %s: %r" % (path, e))
+
+    return Bunch(path=path,
+                 params=params,
+                 pad_tags=pad_tags,
+                 payload_tag_ID=payload_tag_ID,
+                 dictionary=dictionary,
+                 id_map=id_map)
+
+
+def load_pad_set(pad_configs):
+    """
+    Pads detected together, raises ValueError if they can not be.
+
+    Every tag belongs to a single pad, so a detected ID tells which pad it is on. The pads share one detector, whose
+    dictionary holds the tags of every pad (restricted if every pad asks for it) and whose parameters are the ones
+    of the first pad. tag_pads maps every tag ID to the index of its pad, tags holds the pad_tags of every pad.
+    """
+    families = set(pad.params.get("aruco_dict", "DICT_4X4_50") for pad in pad_configs)
+    if len(families) != 1:
+        raise ValueError("pads must use a single dictionary, not %s" % ", ".join(sorted(families)))
+
+    tag_pads = {}
+    tags = {}
+    for index, pad in enumerate(pad_configs):
+        for tag_id, tag in pad.pad_tags.items():
+            if int(tag_id) in tag_pads:
+                raise ValueError("tag %s is on both %s and %s" % (tag_id, pad_configs[tag_pads[int(tag_id)]].path,
+                                                                  pad.path))
+            tag_pads[int(tag_id)] = index
+            tags[tag_id] = tag
+
+    if len(pad_configs) == 1:
+        dictionary, id_map = pad_configs[0].dictionary, pad_configs[0].id_map
+    elif all(pad.id_map is not None for pad in pad_configs):
+        id_map = np.array(sorted(tag_pads), dtype=np.int32)
+        dictionary = restricted_dictionary(get_aruco_dictionary(families.pop()), id_map)
+    else:
+        dictionary, id_map = get_aruco_dictionary(families.pop()), None
+
+    return Bunch(pads=list(pad_configs),
+                 dictionary=dictionary,
+                 id_map=id_map,
+                 tags=tags,
+                 tag_pads=tag_pads,
+                 detector_parameters=pad_configs[0].params.get("detector_parameters", {}))
+
+
+def same_capture_settings(old, new):
+    """
+    True if a camera configuration can be swapped in without reopening the camera
+    """
+    keys = ("capture_method", "device", "camera_width", "camera_height")
+    return all(old.params.get(key) == new.params.get(key) for key in keys) and old.modes == new.modes
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Polls the camera and pad files every period seconds and reloads the ones that changed.
+
+    current holds a (version, camera configs, pad set) tuple, replaced as a whole so readers always see a
+    consistent set. Camera changes that would need the camera to be reopened (capture method, device, size,
+    sensor modes) are rejected like invalid files.
+    """
+    def __init__(self, camera_configs, pad_set, period=1.0, log=print):
+        super().__init__(name="config", daemon=True)
+        self.period = period
+        self.log = log
+        self.current = (0, list(camera_configs), pad_set)
+        self.stamps = {config.path: self._stamp(config.path) for config in list(camera_configs) + pad_set.pads}
+        self.running = True
+
+    @property
+    def version(self):
+        return self.current[0]
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def run(self):
+        while self.running:
+            time.sleep(self.period)
+            self.poll()
+
+    def poll(self):
+        """
+        Reload the files that changed since the last poll, returns True if a new configuration was published
+        """
+        version, camera_configs, pad_set = self.current
+        changed = [path for path, stamp in self.stamps.items() if self._stamp(path) != stamp]
+        if len(changed) == 0:
+            return False
+        for path in changed:
+            self.stamps[path] = self._stamp(path)
+
+        try:
+            camera_configs = list(camera_configs)
+            for index, config in enumerate(camera_configs):
+                if config.path in changed:
+                    new_config = load_camera_config(config.path)
+                    if not same_capture_settings(config, new_config):
+                        raise ValueError("%s: capture settings can not change without a restart" % config.path)
+                    camera_configs[index] = new_config
+            if any(pad.path in changed for pad in pad_set.pads):
+                pad_set = load_pad_set([load_pad_config(pad.path) if pad.path in changed else pad
+                                        for pad in pad_set.pads])
+        except (OSError, ValueError) as e:
+            self.log("config: rejected %s, keeping the running configuration: %s" % (", ".join(changed), e))
+            return False
+
+        self.current = (version + 1, camera_configs, pad_set)
+        self.log("config: reloaded %s" % ", ".join(changed))
+        return True
+
+    def stop(self):
+        self.running = False
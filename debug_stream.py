@@ -0,0 +1,170 @@
+'''
+Debug stream
+Serves annotated camera frames as an MJPEG stream over HTTP
+
+The camera workers only hand their latest frame and detections over (a reference, no copy and no drawing). A
+background thread renders and encodes the latest frame of every stream that has a client, at most max_fps times a
+second and at most max_width pixels wide, so the detection loop pays next to nothing whether or not anybody is
+watching.
+
+Streams are at http://<host>:<port>/<camera name>, e.g. /camera0, with ?view=annotated (default), raw, threshold or
+mosaic (the three side by side). Cameras that have not published a frame yet are not found (404).
+'''
+
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import cv2 as cv
+
+# local modules
+from common import Bunch, draw_str, mosaic
+
+VIEWS = ("annotated", "raw", "threshold", "mosaic")
+
+
+class DebugStream:
+    def __init__(self, port=8080, max_fps=5.0, max_width=800, quality=70):
+        self.max_fps = max_fps
+        self.max_width = max_width
+        self.quality = quality
+
+        # camera name -> latest published Bunch
+        self.latest = {}
+        # (camera name, view) -> (sequence, jpeg bytes)
+        self.encoded = {}
+        # (camera name, view) -> number of connected clients
+        self.clients = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+        stream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stream.serve_client(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="debug-http", daemon=True).start()
+        threading.Thread(target=self._encode_loop, name="debug-encoder", daemon=True).start()
+
+    def publish(self, name, gray, corners, ids, roi=None, poses=(), cam_matrix=None, dist_coefficients=None,
+                stats=""):
+        """
+        Hand over the latest frame of a camera. gray must not be modified afterwards, poses is a list of
+        (rvec, tvec, tag length) to draw axes for.
+        """
+        self.latest[name] = Bunch(gray=gray, corners=corners, ids=ids, roi=roi, poses=poses,
+                                  cam_matrix=cam_matrix, dist_coefficients=dist_coefficients, stats=stats)
+
+    def serve_client(self, handler):
+        url = urlparse(handler.path)
+        name = url.path.strip("/") or "camera0"
+        view = parse_qs(url.query).get("view", ["annotated"])[0]
+        if view not in VIEWS:
+            handler.send_error(404, "unknown view")
+            return
+        if name not in self.latest:
+            handler.send_error(404, "unknown camera")
+            return
+
+        key = (name, view)
+        handler.send_response(200)
+        handler.send_header("Cache-Control", "no-cache")
+        handler.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        handler.end_headers()
+
+        with self.condition:
+            self.clients[key] = self.clients.get(key, 0) + 1
+        try:
+            last_sequence = None
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: key in self.encoded and self.encoded[key][0] != last_sequence,
+                                            timeout=5.0)
+                    if key not in self.encoded or self.encoded[key][0] == last_sequence:
+                        continue
+                    last_sequence, jpeg = self.encoded[key]
+                handler.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(jpeg))
+                handler.wfile.write(jpeg)
+                handler.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.condition:
+                self.clients[key] -= 1
+
+    def _encode_loop(self):
+        rendered = {}
+        while True:
+            start = time.monotonic()
+            with self.condition:
+                watched = [key for key, count in self.clients.items() if count > 0]
+
+            encoded = {}
+            for name, view in watched:
+                frame = self.latest.get(name)
+                # Only encode frames that were not encoded yet
+                if frame is None or rendered.get((name, view)) is frame:
+                    continue
+                rendered[(name, view)] = frame
+                # A frame that fails to render is skipped, the thread has to keep serving the other frames and streams
+                try:
+                    ok, jpeg = cv.imencode(".jpg", self.render(frame, view), [cv.IMWRITE_JPEG_QUALITY, self.quality])
+                except Exception as e:
+                    print("debug stream: failed to encode %s %s: %s" % (name, view, e))
+                    continue
+                if ok:
+                    encoded[(name, view)] = jpeg.tobytes()
+
+            if encoded:
+                with self.condition:
+                    self.sequence += 1
+                    for key, jpeg in encoded.items():
+                        self.encoded[key] = (self.sequence, jpeg)
+                    self.condition.notify_all()
+
+            time.sleep(max(0.0, 1.0 / self.max_fps - (time.monotonic() - start)))
+
+    def render(self, frame, view):
+        # Work on a downscaled copy, everything drawn is scaled to it. The mosaic puts three tiles in max_width.
+        max_width = self.max_width / 3 if view == "mosaic" else self.max_width
+        scale = min(1.0, max_width / frame.gray.shape[1])
+        height, width = frame.gray.shape
+        gray = frame.gray if scale == 1.0 else cv.resize(frame.gray, (int(width * scale), int(height * scale)),
+                                                         interpolation=cv.INTER_AREA)
+        raw = cv.cvtColor(gray, cv.COLOR_GRAY2BGR)
+        if view == "raw":
+            return raw
+
+        threshold = cv.cvtColor(cv.adaptiveThreshold(gray, 255, cv.ADAPTIVE_THRESH_MEAN_C, cv.THRESH_BINARY_INV, 23, 7),
+                                cv.COLOR_GRAY2BGR)
+        if view == "threshold":
+            return threshold
+
+        annotated = raw.copy()
+        if frame.corners is not None and len(frame.corners) > 0:
+            corners = tuple(np.float32(c) * scale for c in frame.corners)
+            cv.aruco.drawDetectedMarkers(annotated, corners, frame.ids)
+        if frame.cam_matrix is not None:
+            cam_matrix = np.array(frame.cam_matrix, dtype=np.float64)
+            cam_matrix[:2] *= scale
+            for rvec, tvec, length in frame.poses:
+                cv.drawFrameAxes(annotated, cam_matrix, frame.dist_coefficients, rvec, tvec, length / 2)
+        if frame.roi is not None:
+            x0, y0, x1, y1 = (int(v * scale) for v in frame.roi)
+            cv.rectangle(annotated, (x0, y0), (x1, y1), (0, 255, 255), 1)
+        for row, line in enumerate(frame.stats.split("\n")):
+            draw_str(annotated, (10, 20 + 16 * row), line)
+
+        if view == "annotated":
+            return annotated
+        return mosaic(3, [raw, threshold, annotated])
+
+    def close(self):
+        self.server.shutdown()
@@ -0,0 +1,151 @@
+'''
+Exposure control
+Closed-loop exposure and gain controller for the global shutter camera
+
+The controller measures the mean intensity of the tag region (the whole frame while no tag is visible) and sets
+ExposureTime, AnalogueGain and FrameDurationLimits so the tags stay at the target intensity. Exposure is kept as
+short as possible, and gain is only raised once the exposure reaches max_exposure, which limits motion blur.
+The frame duration is fixed to hold the target frame rate.
+
+usage:
+    exposure.py [-f <target fps>] [-r <scene radiance>] [-n <frame count>]
+
+runs the controller against a simulated camera and prints its decisions
+
+default values:
+    -f: 60
+    -r: 0.02
+    -n: 60
+'''
+
+import sys
+import getopt
+import numpy as np
+import cv2 as cv
+
+# local modules
+from common import tag_bounds
+
+
+class ExposureController:
+    def __init__(self, target_fps=60.0, target_intensity=110.0, tolerance=8.0, min_exposure=100, max_exposure=3000,
+                 max_gain=16.0, max_step=2.0, damping=0.6, settle_frames=2, log=print):
+        self.target_intensity = target_intensity
+        self.tolerance = tolerance
+        self.max_gain = max_gain
+        self.max_step = max_step
+        self.damping = damping
+        self.settle_frames = settle_frames
+        self.log = log
+
+        # Frame duration in microseconds, the exposure can not be longer than the frame
+        self.frame_duration = int(1e6 / target_fps)
+        self.min_exposure = min_exposure
+        self.max_exposure = min(max_exposure, self.frame_duration)
+
+        self.exposure = self.min_exposure
+        self.gain = 1.0
+        self.intensity = None
+
+        # Frames to skip while the last controls make their way through the sensor pipeline
+        self.settling = 0
+
+    def controls(self):
+        """
+        The camera controls matching the current state of the controller
+        """
+        return {"AeEnable": False,
+                "ExposureTime": int(self.exposure),
+                "AnalogueGain": float(self.gain),
+                "FrameDurationLimits": (self.frame_duration, self.frame_duration)}
+
+    def update(self, gray, corners=()):
+        """
+        Update the exposure from a monochrome frame and the tag corners detected in it.
+        Returns the new camera controls, or None if they do not need to change.
+        """
+        region = tag_region(gray, corners)
+        self.intensity = float(cv.mean(region)[0])
+
+        if self.settling > 0:
+            self.settling -= 1
+            return None
+
+        if abs(self.intensity - self.target_intensity) <= self.tolerance:
+            return None
+
+        # Damped multiplicative step towards the target, the sensor response being linear in exposure * gain
+        ratio = np.clip(self.target_intensity / max(self.intensity, 1.0), 1.0 / self.max_step, self.max_step)
+        total = self.exposure * self.gain * ratio ** self.damping
+
+        # Spend the light budget on exposure first, then on gain
+        exposure = float(np.clip(total, self.min_exposure, self.max_exposure))
+        gain = float(np.clip(total / exposure, 1.0, self.max_gain))
+
+        if abs(exposure - self.exposure) < 1 and abs(gain - self.gain) < 0.01:
+            return None
+
+        self.exposure, self.gain = exposure, gain
+        self.settling = self.settle_frames
+        self.log("exposure: intensity %.0f (target %.0f) -> ExposureTime %d us, AnalogueGain %.2f" % (
+            self.intensity, self.target_intensity, self.exposure, self.gain))
+        return self.controls()
+
+
+def tag_region(gray, corners, margin=0.25):
+    """
+    The part of the frame covered by the tags, grown by margin times its size. The whole frame if there are no tags.
+    """
+    bounds = tag_bounds(corners, margin, gray.shape)
+    if bounds is None:
+        return gray
+    x0, y0, x1, y1 = bounds
+    return gray[y0:y1, x0:x1]
+
+
+class SimulatedCamera:
+    """
+    Stand-in for Picamera2 to exercise the controller: the brightness of a flat scene is proportional to
+    exposure * gain, and new controls only take effect after latency frames like on the real sensor.
+    """
+    def __init__(self, radiance=0.02, size=(160, 130), latency=2, noise=2.0):
+        self.radiance = radiance
+        self.size = size
+        self.noise = noise
+        self.rng = np.random.default_rng(0)
+        self.pending = [{"ExposureTime": 10000, "AnalogueGain": 1.0}] * (latency + 1)
+
+    def set_controls(self, controls):
+        self.pending[-1] = dict(self.pending[-1], **controls)
+
+    def capture_array(self):
+        active = self.pending.pop(0)
+        self.pending.append(dict(self.pending[-1]))
+        level = self.radiance * active["ExposureTime"] * active["AnalogueGain"]
+        frame = level + self.noise * self.rng.standard_normal((self.size[1], self.size[0]))
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], 'f:r:n:', [])
+    args = dict(args)
+    args.setdefault('-f', 60)
+    args.setdefault('-r', 0.02)
+    args.setdefault('-n', 60)
+
+    camera = SimulatedCamera(float(args.get('-r')))
+    controller = ExposureController(float(args.get('-f')))
+    camera.set_controls(controller.controls())
+
+    for _ in range(int(args.get('-n'))):
+        controls = controller.update(camera.capture_array())
+        if controls is not None:
+            camera.set_controls(controls)
+
+    print("final intensity %.0f with ExposureTime %d us, AnalogueGain %.2f" % (
+        controller.intensity, controller.exposure, controller.gain))
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    main()
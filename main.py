@@ -3,25 +3,68 @@ Aruco pose estimation
 uses live camera data to get Aruco tag pose
 
 usage:
-    main.py [-c <camera file>] [-p <pad file>] [-m <send mavlink data>]
+    main.py [-c <camera file>[,<camera file>...]] [-p <pad file>[,<pad file>...]] [-m <send mavlink data>]
+            [-t <thermal sysfs root>] [-d <stage>:<deadline>[,<stage>:<deadline>...]] [-s <debug stream port>]
+            [-g <target selection: closest, mavlink or a payload tag ID>]
 
 usage example:
-    main.py -c camera.json -p pad.json -m
+    main.py -c cameras/down.json,cameras/forward.json -p pad.json -m true
+
+Every camera file gets its own capture/detection worker thread pinned to a CPU core. Every pad is tracked from the
+positions of all cameras, and the pad picked by the target selection policy is sent as a single LANDING_TARGET
+stream.
+While the payload tag is smaller than the camera file's "position_min_tag_size" (pixels, at full sensor resolution),
+only its bearing is sent, with the distance from the autopilot's downward rangefinder.
 
 default values:
-    -c: dingus
+    -c: camera.json
+    -p: pad.json
+    -m: true
+    -t: /sys
+    -d: capture:2.0,detect:2.0,send:2.0
+    -s: 0 (no debug stream)
+    -g: closest
 '''
 
+import os
 import sys
 import getopt
 import time
+import queue
+import threading
 import cv2 as cv
 import numpy as np
-import json
 from pymavlink import mavutil
 from time import sleep, time
 import math
 
+# local modules
+from common import StatValue, tag_bounds
+from camera import Camera, to_gray, ModeSelector
+from config import load_camera_config, load_pad_config, load_pad_set, ConfigWatcher, detector_parameters
+from tracker import CornerTracker
+from exposure import ExposureController
+from pose import PoseEstimator, tag_object_points, pose_covariance
+from scene_gate import SceneGate
+from thermal import ThermalMonitor, ThermalScheduler, WORKLOAD_LEVELS
+from sd_watchdog import Watchdog, parse_deadlines
+from debug_stream import DebugStream
+from bearing import tag_bearing, tag_size, landing_target_angles, PositionModeSwitch
+from targets import TargetTracker, TargetSelector
+
+# Bearings older than this (seconds) are left out of the fused target
+FUSION_MAX_AGE = 0.1
+
+# Rangefinder readings older than this (seconds) are not sent with the bearings
+RANGEFINDER_MAX_AGE = 0.5
+
+# Longest wait (seconds) for measurements before the autopilot connection is read again. Rangefinder readings are
+# stamped when read, so this bounds how late their time can be.
+AUTOPILOT_POLL_PERIOD = 0.05
+
+# Seconds between two prints of the per-camera statistics
+STATS_PERIOD = 5.0
+
 
 def rotate_vector_3d(position, rot_vector):
     """
@@ -38,6 +81,15 @@ def rotate_vector_3d(position, rot_vector):
     Returns:
         np.ndarray: The rotated 3D position vector.
     """
+    # Apply rotation
+    rotated_position = rotation_matrix(rot_vector) @ position
+    return rotated_position
+
+
+def rotation_matrix(rot_vector):
+    """
+    The rotation matrix rotate_vector_3d applies for the given Euler angles
+    """
     rx, ry, rz = rot_vector  # Extract Euler angles for rotation about each axis.
 
     # Rotation matrix about the x-axis.
@@ -64,10 +116,7 @@ def rotate_vector_3d(position, rot_vector):
     # Combine the rotations. Here we apply Rx, then Ry, then Rz.
     # Note: Matrix multiplication is not commutative so the order matters.
     R = Rz @ Ry @ Rx
-
-    # Apply rotation
-    rotated_position = R @ position
-    return rotated_position
+    return R
 
 
 def wait_heartbeat(m):
@@ -78,15 +127,48 @@ def wait_heartbeat(m):
 
 def average_vectors(vector_list):
     avg_vec = np.array([0, 0, 0], dtype=np.float32)
-    for x in range(vector_list.length):
-        avg_vec += vector_list[x] / vector_list.length
+    for x in range(len(vector_list)):
+        avg_vec += vector_list[x] / len(vector_list)
     return avg_vec
 
 
-def compute_position(detected_corners, aruco_ids, pad_tags, payload_tag_ID, camera_offset, cam_matrix, dist_coefficients):
+def create_detector(pad_set):
+    """
+    Build the aruco detector for a pad set loaded by config.load_pad_set
+    """
+    aruco_parameters = detector_parameters(pad_set.detector_parameters)
+    return cv.aruco.ArucoDetector(pad_set.dictionary, aruco_parameters)
+
+
+def detect_markers(aruco_detector, gray, roi=None, downscale=1):
+    """
+    detectMarkers restricted to the roi (x0, y0, x1, y1) and run on the frame downscaled by downscale,
+    the corners are returned in full frame coordinates
+    """
+    x0, y0 = 0, 0
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        gray = gray[y0:y1, x0:x1]
+    if downscale > 1:
+        gray = cv.resize(gray, None, fx=1.0 / downscale, fy=1.0 / downscale, interpolation=cv.INTER_AREA)
+
+    aruco_corners, aruco_ids, rejected = aruco_detector.detectMarkers(gray)
+
+    if (x0 or y0 or downscale > 1) and len(aruco_corners) > 0:
+        # Pixel centers are at half pixels
+        offset = np.float32([x0, y0]) + 0.5 * (downscale - 1)
+        aruco_corners = tuple(c * downscale + offset for c in aruco_corners)
+    return aruco_corners, aruco_ids, rejected
+
+
+def compute_position(detected_corners, aruco_ids, pad_tags, payload_tag_ID, camera_offset, cam_matrix, dist_coefficients,
+                     pose_estimator=None, now=None):
     """
     Given the input detected tags, pad tags, payload tag, and camera offset vectors, this function returns a
     single position vector for sending to the flight controller
+
+    With a pose_estimator, each tag pose is disambiguated and refined from the tag's previous pose (at time now),
+    otherwise every tag is solved from scratch.
     """
 
     # Initialize the return vector
@@ -104,19 +186,15 @@ def compute_position(detected_corners, aruco_ids, pad_tags, payload_tag_ID, came
         # Check if we care about the particular tag
         if pad_tags.get(str(aruco_ids[x][0])) is not None:
 
-            # Get the measured length of the tag being detected
-            markerLength = pad_tags[str(aruco_ids[x][0])][0] / 2
-
-            # Set coordinate system
-            obj_points = np.array([
-                [-markerLength, markerLength, 0],
-                [markerLength, markerLength, 0],
-                [markerLength, -markerLength, 0],
-                [-markerLength, -markerLength, 0]
-            ], dtype=np.float32)
+            # Set coordinate system from the measured length of the tag being detected
+            obj_points = tag_object_points(pad_tags[str(aruco_ids[x][0])][0])
 
             # Compute the rotation and rotation
-            flag, rvec, tvec = cv.solvePnP(obj_points, detected_corners[x], cam_matrix, dist_coefficients, flags=cv.SOLVEPNP_IPPE_SQUARE)
+            if pose_estimator is not None:
+                rvec, tvec = pose_estimator.solve(int(aruco_ids[x][0]), obj_points, detected_corners[x],
+                                                  cam_matrix, dist_coefficients, now)
+            else:
+                flag, rvec, tvec = cv.solvePnP(obj_points, detected_corners[x], cam_matrix, dist_coefficients, flags=cv.SOLVEPNP_IPPE_SQUARE)
 
             # Add the tag ID and position to the detected_tags dict
             detected_tags[int(aruco_ids[x][0])] = (tvec.flatten(), rvec.flatten())
@@ -136,16 +214,411 @@ def compute_position(detected_corners, aruco_ids, pad_tags, payload_tag_ID, came
     return final_vec
 
 
+def payload_corners(detected_corners, aruco_ids, payload_tag_ID):
+    """
+    Corners of the payload tag, or None if it was not detected
+    """
+    if aruco_ids is None:
+        return None
+    for corners, tag_id in zip(detected_corners, np.ravel(aruco_ids)):
+        if tag_id == payload_tag_ID:
+            return corners
+    return None
+
+
+class CameraWorker(threading.Thread):
+    """
+    Captures and processes the frames of a single camera on its own thread.
+
+    Every measurement is put on the shared results queue as a (camera index, capture time, pad index, kind, value,
+    covariance, reused) tuple, kind being "position" or "bearing" (a unit line of sight, while the payload tag is too small
+    for its pose to be solved), the value already being transformed through the camera offset. Every pad whose
+    payload tag is in view gets its own measurement. Positions come with their 3x3 covariance (square meters), and
+    are dropped if the camera file's "pose_quality" limits (max_reprojection_error pixels, max_position_std meters)
+    are exceeded. Bearings have no covariance. Frames the scene gate skips repeat the measurements of the last
+    processed frame with reused set. OpenCV releases the GIL while capturing and
+    detecting, so the workers of several cameras run in parallel.
+
+    With a config_watcher, reloaded calibrations, camera offsets and pad models are swapped in between two frames,
+    and the redetection interval, exposure controller, mode switch and scene gate follow their edited settings.
+    """
+    def __init__(self, index, camera_config, pad_set, results, core=None, thermal_scheduler=None,
+                 config_watcher=None, watchdog=None, debug_stream=None):
+        super().__init__(name="camera%d" % index, daemon=True)
+        self.index = index
+        self.camera_config = camera_config
+        self.camera_params = camera_config.params
+        self.pad_set = pad_set
+        self.results = results
+        self.core = core
+        self.thermal_scheduler = thermal_scheduler
+        self.config_watcher = config_watcher
+        self.config_version = 0
+        self.debug_stream = debug_stream
+        self.running = True
+
+        # Report capture and detection progress to the systemd watchdog
+        self.watchdog = watchdog
+        if watchdog is not None:
+            watchdog.add_stage(self.name + ".capture", "capture")
+            watchdog.add_stage(self.name + ".detect", "detect")
+
+        # The calibration is valid in every sensor mode once the camera matrix is scaled to it
+        self.modes = camera_config.modes
+        self.mode_index = 0
+
+        # Frames per second and capture to position latency (seconds)
+        self.frame_rate = StatValue(0.9)
+        self.latency = StatValue(0.9)
+        self.mode_frame_rates = [StatValue(0.9) for mode in self.modes]
+        self.mode_switch_latency = StatValue(0.5)
+        self.frame_count = 0
+        self.detection_count = 0
+        self.tracked_count = 0
+        self.skipped_count = 0
+        self.gated_count = 0
+        # (reprojection error, position standard deviation) of the last solved payload pose
+        self.pose_quality = None
+
+    def run(self):
+        # Pin the thread to its core, pid 0 is the calling thread on Linux
+        if self.core is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, {self.core})
+
+        camera = Camera(self.camera_params)
+
+        # The detector is not shared between threads
+        aruco_detector = create_detector(self.pad_set)
+
+        # Track the tag corners between full detections
+        redetect_interval = int(self.camera_params.get("redetect_interval", 1))
+        tracker = CornerTracker(redetect_interval)
+
+        # Drive the exposure from the tag region instead of the sensor's auto exposure
+        exposure_controller = self.create_exposure_controller(self.camera_params)
+        if exposure_controller is not None:
+            camera.set_controls(exposure_controller.controls())
+
+        # Solve each tag from its previous pose
+        pose_estimator = PoseEstimator()
+
+        # Switch to binned or cropped modes when the tags are large enough
+        mode_selector = self.create_mode_selector(self.camera_params)
+
+        # Skip detection on frames identical to the last processed one
+        scene_gate = self.create_scene_gate(self.camera_params)
+
+        # Only send the bearing of tags too small to solve their pose, deciding for every pad on its own
+        position_switches = [PositionModeSwitch(self.camera_params.get("position_min_tag_size", 0))
+                             for pad in self.pad_set.pads]
+
+        aruco_corners, aruco_ids, measurements, roi = (), None, [], None
+        processed_time = None
+        last_frame_time = None
+        try:
+            while self.running:
+                # Follow the workload profile of the current temperature
+                profile = WORKLOAD_LEVELS[0]
+                if self.thermal_scheduler is not None:
+                    profile = self.thermal_scheduler.profile
+                if profile.max_workers is not None and self.index >= profile.max_workers:
+                    sleep(0.1)
+                    last_frame_time = None
+                    self.report_progress("capture")
+                    self.report_progress("detect")
+                    continue
+                tracker.redetect_interval = redetect_interval * profile.detection_interval
+
+                # Swap in the configuration reloaded since the last frame
+                if self.config_watcher is not None and self.config_watcher.version != self.config_version:
+                    self.config_version, camera_configs, pad_set = self.config_watcher.current
+                    if pad_set is not self.pad_set:
+                        aruco_detector = create_detector(pad_set)
+                        tracker.reset()
+                    old_params = self.camera_config.params
+                    self.camera_config, self.pad_set = camera_configs[self.index], pad_set
+                    params = self.camera_config.params
+                    redetect_interval = int(params.get("redetect_interval", 1))
+                    for position_switch in position_switches:
+                        position_switch.min_tag_size = params.get("position_min_tag_size", 0)
+                    pose_estimator.reset()
+
+                    # Rebuild the stages whose settings were edited, the others keep their state
+                    if params.get("exposure") != old_params.get("exposure"):
+                        exposure_controller = self.create_exposure_controller(params)
+                        camera.set_controls(exposure_controller.controls() if exposure_controller is not None
+                                            else {"AeEnable": True})
+                    if params.get("mode_switch") != old_params.get("mode_switch") and mode_selector is not None:
+                        mode_selector = self.create_mode_selector(params)
+                        mode_selector.current = self.mode_index
+                    if params.get("scene_gate") != old_params.get("scene_gate"):
+                        scene_gate = self.create_scene_gate(params)
+                    if scene_gate is not None:
+                        scene_gate.reset()
+
+                # aquire camera image
+                frame = camera.read()
+                capture_time = time()
+                if frame is None:
+                    continue
+                self.report_progress("capture")
+
+                # Make it monochrome
+                frame = to_gray(frame)
+
+                # Reuse the previous detections and pose while the scene does not change
+                if scene_gate is None or scene_gate.changed(frame, aruco_corners):
+                    roi = None
+                    processed_time = capture_time
+
+                    # Follow the tags with optical flow, unless it is time for a full detection or the tracks were lost
+                    aruco_ids = None
+                    if not tracker.need_detection():
+                        aruco_corners, aruco_ids = tracker.track(frame)
+                        if aruco_ids is not None:
+                            self.tracked_count += 1
+
+                    if aruco_ids is None:
+                        # Only look around the last known tags when running hot
+                        if profile.roi_margin is not None:
+                            roi = tag_bounds(aruco_corners, profile.roi_margin, frame.shape)
+
+                        # Detect the tag corners
+                        aruco_corners, aruco_ids, rejected = detect_markers(aruco_detector, frame, roi,
+                                                                            profile.downscale)
+
+                        # Translate the reduced dictionary indices back to the pad IDs
+                        if self.pad_set.id_map is not None and aruco_ids is not None:
+                            aruco_ids = self.pad_set.id_map[aruco_ids]
+
+                        tracker.update_detection(frame, aruco_corners, aruco_ids)
+
+                    if exposure_controller is not None:
+                        controls = exposure_controller.update(frame, aruco_corners)
+                        if controls is not None:
+                            camera.set_controls(controls)
+
+                    measurements = self.measure(aruco_corners, aruco_ids, position_switches, pose_estimator,
+                                                capture_time)
+                else:
+                    self.skipped_count += 1
+                self.report_progress("detect")
+
+                if self.debug_stream is not None:
+                    self.publish_debug(frame, aruco_corners, aruco_ids, roi, pose_estimator, processed_time, profile)
+
+                # Measurements of the last processed frame are marked as reused
+                for pad, kind, value, covariance in measurements:
+                    self.results.put((self.index, capture_time, pad, kind, value, covariance,
+                                      processed_time != capture_time))
+                if len(measurements) > 0:
+                    self.detection_count += 1
+
+                self.latency.update(time() - capture_time)
+                if last_frame_time is not None:
+                    rate = 1.0 / max(capture_time - last_frame_time, 1e-6)
+                    self.frame_rate.update(rate)
+                    self.mode_frame_rates[self.mode_index].update(rate)
+                last_frame_time = capture_time
+                self.frame_count += 1
+
+                new_mode = mode_selector.update(aruco_corners) if mode_selector is not None else None
+                if new_mode is not None:
+                    switch_latency = camera.set_mode(self.modes[new_mode])
+                    self.mode_switch_latency.update(switch_latency)
+                    print("%s: sensor mode %d -> %d (%dx%d) in %.1f ms" % (
+                        self.name, self.mode_index, new_mode,
+                        self.modes[new_mode]["width"], self.modes[new_mode]["height"], 1000 * switch_latency))
+                    self.mode_index = new_mode
+
+                    # Pixel coordinates changed, and the new configuration needs the exposure controls again
+                    aruco_corners, aruco_ids, measurements = (), None, []
+                    tracker.reset()
+                    if scene_gate is not None:
+                        scene_gate.reset()
+                    if exposure_controller is not None:
+                        camera.set_controls(exposure_controller.controls())
+                    last_frame_time = None
+        finally:
+            camera.close()
+
+    def create_exposure_controller(self, params):
+        """
+        Exposure controller of the exposure block of the camera parameters, None to leave the sensor's auto exposure
+        """
+        if "exposure" not in params:
+            return None
+        return ExposureController(log=lambda message: print("%s %s" % (self.name, message)), **params["exposure"])
+
+    def create_mode_selector(self, params):
+        """
+        Sensor mode selector of the mode_switch block of the camera parameters, None with a single mode
+        """
+        if len(self.modes) <= 1:
+            return None
+        return ModeSelector(self.modes, **params.get("mode_switch", {}))
+
+    def create_scene_gate(self, params):
+        """
+        Scene change gate of the scene_gate block of the camera parameters, None to process every frame
+        """
+        if "scene_gate" not in params:
+            return None
+        return SceneGate(**params["scene_gate"])
+
+    def measure(self, aruco_corners, aruco_ids, position_switches, pose_estimator, capture_time):
+        """
+        (pad index, kind, value, covariance) of every pad whose payload tag was detected
+        """
+        measurements = []
+        if aruco_ids is None or len(aruco_corners) == 0:
+            return measurements
+
+        cam_matrix = self.camera_config.mode_matrices[self.mode_index]
+        binning = self.modes[self.mode_index].get("binning", 1)
+        for pad_index, pad in enumerate(self.pad_set.pads):
+            payload = payload_corners(aruco_corners, aruco_ids, pad.payload_tag_ID)
+            if payload is None:
+                continue
+
+            # Only the direction of a payload tag too small for its pose, sized in full resolution pixels
+            if not position_switches[pad_index].update(tag_size(payload) * binning):
+                bearing = rotate_vector_3d(tag_bearing(payload, cam_matrix, self.camera_config.dist_coefficients),
+                                           self.camera_config.camera_offset[1])
+                measurements.append((pad_index, "bearing", bearing, None))
+                continue
+
+            # compute the location of the payload
+            computed_position = compute_position(aruco_corners,
+                                                 aruco_ids,
+                                                 pad.pad_tags,
+                                                 pad.payload_tag_ID,
+                                                 self.camera_config.camera_offset,
+                                                 cam_matrix,
+                                                 self.camera_config.dist_coefficients,
+                                                 pose_estimator,
+                                                 capture_time)
+            if computed_position is False:
+                continue
+
+            # Uncertainty of the payload pose, in meters and rotated like the position
+            t, rvec, tvec = pose_estimator.poses[pad.payload_tag_ID]
+            error, covariance = pose_covariance(tag_object_points(pad.pad_tags[str(pad.payload_tag_ID)][0]), payload,
+                                                rvec, tvec, cam_matrix, self.camera_config.dist_coefficients)
+            R = rotation_matrix(self.camera_config.camera_offset[1])
+            covariance = 1e-6 * R @ covariance[3:, 3:] @ R.T
+            std = float(np.sqrt(np.trace(covariance)))
+            self.pose_quality = (error, std)
+
+            limits = self.camera_config.params.get("pose_quality", {})
+            if error > limits.get("max_reprojection_error", np.inf) or std > limits.get("max_position_std", np.inf):
+                self.gated_count += 1
+                continue
+            measurements.append((pad_index, "position", computed_position, covariance))
+        return measurements
+
+    def publish_debug(self, frame, aruco_corners, aruco_ids, roi, pose_estimator, processed_time, profile):
+        # Axes of the tags solved on the last processed frame
+        poses = [(rvec, tvec, self.pad_set.tags[str(tag_id)][0])
+                 for tag_id, (t, rvec, tvec) in pose_estimator.poses.items() if t == processed_time]
+        stats = "%s %.1f fps %.1f ms\nmode %d, detection interval x%d, downscale %d" % (
+            self.name, self.frame_rate.value or 0.0, 1000 * (self.latency.value or 0.0),
+            self.mode_index, profile.detection_interval, profile.downscale)
+        if self.pose_quality is not None:
+            stats += "\npayload reprojection %.2f px, position std %.3f m" % self.pose_quality
+        self.debug_stream.publish(self.name, frame, aruco_corners, aruco_ids, roi, poses,
+                                  self.camera_config.mode_matrices[self.mode_index],
+                                  self.camera_config.dist_coefficients, stats)
+
+    def report_progress(self, stage):
+        if self.watchdog is not None:
+            self.watchdog.progress(self.name + "." + stage)
+
+    def stop(self):
+        self.running = False
+
+
+def fuse_positions(latest, now, max_age=FUSION_MAX_AGE):
+    """
+    Fuse the latest position of every camera into a single target position.
+
+    latest maps a camera index to its last (capture time, position). Positions older than max_age seconds are
+    ignored, the others are averaged. Returns the fused position and the newest capture time used, or (False, None)
+    if no camera has a recent enough position.
+    """
+    recent = [(t, position) for t, position in latest.values() if now - t <= max_age]
+    if len(recent) == 0:
+        return False, None
+    return average_vectors([position for t, position in recent]), max(t for t, position in recent)
+
+
+def fuse_bearings(latest, now, max_age=FUSION_MAX_AGE):
+    """
+    Fuse the latest bearing of every camera into a single unit line of sight, like fuse_positions
+    """
+    bearing, capture_time = fuse_positions(latest, now, max_age)
+    if bearing is False:
+        return False, None
+    return bearing / np.linalg.norm(bearing), capture_time
+
+
+def read_autopilot(connection, rangefinder, selector):
+    """
+    Drain the pending rangefinder messages and target commands.
+
+    Returns the last rangefinder (time, distance in meters), or the given one if there is no new reading. Only
+    downward facing DISTANCE_SENSORs are used. MAV_CMD_USER_1 commands are passed to the target selector and
+    acknowledged.
+    """
+    while True:
+        msg = connection.recv_match(type=['DISTANCE_SENSOR', 'RANGEFINDER', 'COMMAND_LONG'], blocking=False)
+        if msg is None:
+            return rangefinder
+        if msg.get_type() == 'RANGEFINDER':
+            rangefinder = (time(), msg.distance)
+        elif msg.get_type() == 'DISTANCE_SENSOR':
+            if msg.orientation == mavutil.mavlink.MAV_SENSOR_ROTATION_PITCH_270:
+                rangefinder = (time(), msg.current_distance / 100.0)
+        elif msg.command == mavutil.mavlink.MAV_CMD_USER_1 and msg.target_system in (0, connection.source_system):
+            accepted = selector.command(int(msg.param1))
+            print("target command %d %s" % (int(msg.param1), "accepted" if accepted else "denied"))
+            connection.mav.command_ack_send(msg.command, mavutil.mavlink.MAV_RESULT_ACCEPTED if accepted
+                                            else mavutil.mavlink.MAV_RESULT_DENIED)
+
+
+def print_stats(workers):
+    for worker in workers:
+        print("%s: %.1f fps, %.1f ms latency, %d/%d frames with a target, %d tracked, %d unchanged, "
+              "%d poses gated" % (
+                  worker.name,
+                  worker.frame_rate.value or 0.0,
+                  1000 * (worker.latency.value or 0.0),
+                  worker.detection_count,
+                  worker.frame_count,
+                  worker.tracked_count,
+                  worker.skipped_count,
+                  worker.gated_count))
+        if len(worker.modes) > 1:
+            print("%s: sensor mode %d, %s fps per mode, %.1f ms per mode switch" % (
+                worker.name,
+                worker.mode_index,
+                "/".join("%.1f" % (rate.value or 0.0) for rate in worker.mode_frame_rates),
+                1000 * (worker.mode_switch_latency.value or 0.0)))
+
+
 def main():
 
     # Get CMD arguments
     try:
-        args, img_names = getopt.getopt(sys.argv[1:], 'c:p:m:v', [])
-    except:
+        args, img_names = getopt.getopt(sys.argv[1:], 'c:p:m:v:t:d:s:g:', [])
+    except getopt.GetoptError:
         # print help information and exit
         print("""usage:
-    main.py [-c <camera file>] [-p <pad file>] [-m <mavlink communication true/false>] [-v <GUI true/false>]
+    main.py [-c <camera file>[,<camera file>...]] [-p <pad file>[,<pad file>...]] [-m <mavlink communication true/false>]
+            [-v <GUI true/false>] [-t <thermal sysfs root>] [-d <stage>:<deadline>[,<stage>:<deadline>...]]
+            [-s <debug stream port>] [-g <target selection: closest, mavlink or a payload tag ID>]
 """)
+        return
     args = dict(args)
 
     # Set the default values
@@ -153,54 +626,40 @@ def main():
     args.setdefault('-p', 'pad.json')
     args.setdefault('-m', 'true')
     args.setdefault('-v', 'false')
+    args.setdefault('-t', '/sys')
+    args.setdefault('-d', '')
+    args.setdefault('-s', '0')
+    args.setdefault('-g', 'closest')
 
 
     # Assign arguments to variables
-    calibration_data_file = str(args.get('-c'))
-    pad_data_file = str(args.get('-p'))
+    calibration_data_files = str(args.get('-c')).split(',')
+    pad_data_files = str(args.get('-p')).split(',')
     use_mavlink = args.get('-m').lower() == 'true'
     use_GUI = args.get('-v').lower() == 'true'
+    thermal_sysfs_root = str(args.get('-t'))
+    watchdog_deadlines = parse_deadlines(str(args.get('-d')))
+    debug_stream_port = int(args.get('-s'))
+    target_policy = str(args.get('-g'))
 
     # start the visualizer if the argument was set
     if use_GUI:
         import vector_vis
         vector_vis.start_visualizer()
 
-    # Read the camera parameters
-    camera_params = json.loads(open(calibration_data_file, 'r').read())
-
-    if camera_params["capture_method"] == "OpenCV":
-        # Create OpenCV cam
-        cam = cv.VideoCapture(0)
-
-        # set OpenCV camera params
-        cam.set(cv.CAP_PROP_FRAME_WIDTH, camera_params["camera_width"])
-        cam.set(cv.CAP_PROP_FRAME_HEIGHT, camera_params["camera_height"])
-
-    elif camera_params["capture_method"] == "PiCamera":
-        from picamera2 import Picamera2
-        # Create pi camera
-        camera = Picamera2()
-        camera.configure(camera.create_preview_configuration(
-            main={"size": (camera_params["camera_width"], camera_params["camera_height"])}))
-        camera.start()
-    else:
-        print("Invalid Camera capture method")
+    # Read the camera and landing pad parameters
+    try:
+        camera_configs = [load_camera_config(calibration_data_file)
+                          for calibration_data_file in calibration_data_files]
+        pad_set = load_pad_set([load_pad_config(pad_data_file) for pad_data_file in pad_data_files])
+        target_selector = TargetSelector([pad.payload_tag_ID for pad in pad_set.pads], target_policy)
+    except (OSError, ValueError) as e:
+        print(e)
         return
 
-    # assign the separate calibration matrices
-    cam_matrix = np.array(camera_params["calibration"][0])
-    dist_coefficients = np.array(camera_params["calibration"][1])
-
-    # Set the aruco dict
-    aruco_dict = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_50)
-    aruco_parameters = cv.aruco.DetectorParameters()
-    aruco_detector = cv.aruco.ArucoDetector(aruco_dict, aruco_parameters)
-
-
-
-    # Read the landing lad parameters
-    pad_params = json.loads(open(pad_data_file, 'r').read())
+    # Pick up edits of the camera and pad files without restarting
+    config_watcher = ConfigWatcher(camera_configs, pad_set)
+    config_watcher.start()
 
     if use_mavlink:
         # Start a connection listening on the serial port
@@ -209,40 +668,137 @@ def main():
         # Wait for the first heartbeat
         wait_heartbeat(the_connection)
 
-    # Main Program loop
-    while True:
-        sleep(0.03)
-
-        # aquire camera image
-        if camera_params["capture_method"] == "OpenCV":
-            #Capture openCV frame
-            ret, frame = cam.read()
-        elif camera_params["capture_method"] == "PiCamera":
-            # Create pi camera
-            # Capture picamera frame
+    # Lighten the workload as the CPU heats up
+    thermal_scheduler = ThermalScheduler(ThermalMonitor(thermal_sysfs_root))
+
+    # Tell systemd when we are up and keep pinging it while every stage makes progress
+    watchdog = Watchdog(watchdog_deadlines)
+    watchdog.add_stage("send")
+
+    # Serve annotated frames for tuning in the field
+    debug_stream = None
+    if debug_stream_port:
+        debug_stream = DebugStream(debug_stream_port)
+
+    # Start one worker per camera, leaving core 0 to this thread unless the camera file asks for a core
+    core_count = os.cpu_count() or 1
+    results = queue.Queue()
+    workers = []
+    for index, camera_config in enumerate(camera_configs):
+        core = camera_config.params.get("core", (index + 1) % core_count)
+        workers.append(CameraWorker(index, camera_config, pad_set, results, core, thermal_scheduler,
+                                    config_watcher, watchdog, debug_stream))
+    for worker in workers:
+        worker.start()
+
+    # Filtered position of every pad, and the last (capture time, bearing) of every pad from every camera
+    target_tracker = TargetTracker(len(pad_set.pads))
+    latest_bearings = {}
+    config_version = config_watcher.version
+    # Last (time, distance) measured by the autopilot's rangefinder
+    rangefinder = None
+    last_stats = time()
 
-            frame = camera.capture_array()
-
-        # Make it monochrome
-        frame = cv.cvtColor(frame, cv.COLOR_RGBA2BGR)
-
-        # Detect the tag corners
-        aruco_corners, aruco_ids, rejected = aruco_detector.detectMarkers(frame)
-
-        # compute the location of the payload
-        computed_position = compute_position(aruco_corners,
-                                             aruco_ids,
-                                             pad_params["pad_tags"],
-                                             int(pad_params["payload_tag_ID"]),
-                                             camera_params["camera_offset"],
-                                             cam_matrix,
-                                             dist_coefficients)
+    # Main Program loop
+    while any(worker.is_alive() for worker in workers):
+        thermal_scheduler.update()
+
+        # Getting back here means the last send went through
+        watchdog.progress("send")
+        watchdog.update()
+
+        # Print the per-camera rate and latency from time to time
+        if time() - last_stats > STATS_PERIOD:
+            print_stats(workers)
+            last_stats = time()
+
+        # Target commands are answered and rangefinder readings stamped even while no pad is in view
+        if use_mavlink:
+            rangefinder = read_autopilot(the_connection, rangefinder, target_selector)
+
+        # Take every measurement waiting, so all the tracks are updated at once
+        try:
+            batch = [results.get(timeout=AUTOPILOT_POLL_PERIOD)]
+        except queue.Empty:
+            continue
+        while True:
+            try:
+                batch.append(results.get_nowait())
+            except queue.Empty:
+                break
+
+        # Payload tag IDs may have been edited
+        if config_watcher.version != config_version:
+            config_version, camera_configs, pad_set = config_watcher.current
+            target_selector.payload_ids = [pad.payload_tag_ID for pad in pad_set.pads]
+
+        positions = [(pad, capture_time, value, covariance)
+                     for index, capture_time, pad, kind, value, covariance, reused in batch
+                     if kind == "position" and not reused]
+        # Pads whose track this batch moved forward, measurements rejected at the gate leave theirs as it was
+        updated = set()
+        if len(positions) > 0:
+            rows, _rejected = target_tracker.update(*zip(*positions))
+            updated.update(rows.tolist())
+
+        # Reused measurements are not fused again, they only tell the scene and so the tracks are still current
+        unchanged = [(pad, capture_time) for index, capture_time, pad, kind, value, covariance, reused in batch
+                     if kind == "position" and reused]
+        if len(unchanged) > 0:
+            updated.update(target_tracker.refresh(*zip(*unchanged)).tolist())
+
+        bearing_pads = set()
+        for index, capture_time, pad, kind, value, covariance, reused in batch:
+            if kind == "bearing":
+                latest_bearings.setdefault(pad, {})[index] = (capture_time, value)
+                bearing_pads.add(pad)
+
+        # A tracked position of any pad beats the bearings, only send the selected pad when this batch updated it
+        selected = target_selector.select(target_tracker, time())
+        if selected is None:
+            bearings = {}
+            for pad, latest in latest_bearings.items():
+                bearing, capture_time = fuse_bearings(latest, time())
+                if not (bearing is False):
+                    bearings[pad] = (bearing, capture_time)
+            pad = target_selector.select_bearing({pad: bearing for pad, (bearing, t) in bearings.items()})
+            if pad is not None and pad in bearing_pads:
+                computed_bearing, capture_time = bearings[pad]
+                angle_x, angle_y = landing_target_angles(computed_bearing)
+
+                # Distance along the line of sight from the height, 0 if there is no recent reading
+                distance = 0
+                if rangefinder is not None and time() - rangefinder[0] <= RANGEFINDER_MAX_AGE and \
+                        computed_bearing[2] > 0:
+                    distance = rangefinder[1] / computed_bearing[2]
+
+                if use_mavlink:
+                    the_connection.mav.landing_target_send(int(capture_time * 1000000),  # Time since "boot"
+                                                           pad,  # target number
+                                                           mavutil.mavlink.MAV_FRAME_BODY_NED,  # Reference frame
+                                                           angle_x,  # X-axis angular offset of the target
+                                                           angle_y,  # Y-axis angular offset of the target
+                                                           distance,  # distance to the target
+                                                           0,  # not used
+                                                           0,  # not used
+                                                           0,  # not used
+                                                           0,  # not used
+                                                           0,  # not used
+                                                           [0, 0, 0, 1],  # not used
+                                                           0,  # not used
+                                                           0  # marks that only the angles are valid
+                                                           )
+
+                print("pad %d bearing %.4f %.4f rad, %.2f m" % (pad, angle_x, angle_y, distance))
 
         # Make sure that tags were actually detected
-        if not (computed_position is False) and use_mavlink:
+        elif selected in updated and use_mavlink:
+            computed_position = target_tracker.position[selected]
+            capture_time = target_tracker.time[selected]
+
             # Send the location to the flight controller
-            the_connection.mav.landing_target_send(int(time() * 1000000),  # Time since "boot"
-                                                 0,  # not used
+            the_connection.mav.landing_target_send(int(capture_time * 1000000),  # Time since "boot"
+                                                 selected,  # target number
                                                  mavutil.mavlink.MAV_FRAME_BODY_NED,  # Reference frame
                                                  0,  # angle_x, not used since we have position
                                                  0,  # angle_y, not used since we have position
@@ -257,10 +813,14 @@ def main():
                                                  1  # marks that we want to use x, y, z coords
                                                  )
 
-            # Print the computed result to the console for debugging
-            print(computed_position)
-# ======================================================================================================================
+            # Print the computed result and its standard deviation to the console for debugging
+            print(selected, computed_position, "+/- %.3f m" % np.sqrt(target_tracker.variance[selected]))
 
+    # Every worker died, fail so systemd restarts the service
+    print("every camera worker stopped")
+    sys.exit(1)
+# ======================================================================================================================
 
-main()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+'''
+Detector parameter sweep
+Measures detection latency and quality over a grid of aruco DetectorParameters and prints the Pareto front
+
+Every configuration of the grid is run over the same frames on a process pool. For each one the per-frame detection
+latency, the detection rate (ground truth markers found), the false positives per frame and the mean corner error
+of the found markers are measured. The configurations that no other one beats on both latency and detection rate
+are printed, and the one with the best detection rate is written as a "detector_parameters" block ready to be
+pasted into a pad file.
+
+Frames come either from a ground truth file listing images and their markers:
+    {"frames": [{"image": "flight/0001.png", "markers": [{"id": 0, "corners": [[x, y], [x, y], [x, y], [x, y]]}]}]}
+or are synthesized from the pad's tags at random sizes, perspectives, blur and noise.
+
+usage:
+    param_sweep.py [-p <pad file>] [-g <ground truth file>] [-n <synthetic frame count>] [-j <processes>]
+    [-o <output file>] [--max_fp=<false positives per frame>]
+
+usage example:
+    param_sweep.py -p pads/simple_pad.json -n 100 -j 4 -o sweep.json
+
+default values:
+    -p: pad.json
+    -g: synthetic frames
+    -n: 50
+    -j: number of CPUs
+    -o: sweep.json
+    --max_fp: 0.05
+'''
+
+import os
+import sys
+import getopt
+import json
+import itertools
+import time
+from multiprocessing import Pool
+import numpy as np
+import cv2 as cv
+
+# local modules
+from config import load_pad_config, detector_parameters
+
+# Decimation is ArUco3 detection, which detects on an image downscaled so the smallest marker keeps the given ratio
+GRID = {
+    "adaptiveThreshWinSizeMin": [3, 7],
+    "adaptiveThreshWinSizeMax": [23, 35],
+    "adaptiveThreshWinSizeStep": [10],
+    "minMarkerPerimeterRate": [0.01, 0.03],
+    "maxMarkerPerimeterRate": [4.0],
+    "cornerRefinementMethod": [cv.aruco.CORNER_REFINE_NONE, cv.aruco.CORNER_REFINE_SUBPIX,
+                               cv.aruco.CORNER_REFINE_CONTOUR],
+    "decimation": [(False, 0.0), (True, 0.02), (True, 0.05)],
+}
+
+# Detections further than this (pixels, mean over the corners) from a ground truth marker do not match it
+MATCH_DISTANCE = 5.0
+
+SYNTHETIC_SIZE = (1600, 1300)
+
+
+def grid_configurations(grid=GRID):
+    """
+    Every combination of the grid, as detector_parameters dicts
+    """
+    names = list(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        configuration = dict(zip(names, values))
+        use_aruco3, ratio = configuration.pop("decimation")
+        configuration["useAruco3Detection"] = use_aruco3
+        configuration["minMarkerLengthRatioOriginalImg"] = ratio
+        yield configuration
+
+
+def synthetic_frames(dictionary, tags, count, seed=0):
+    """
+    Frames holding a few markers at random sizes and perspectives, with their ground truth corners.
+    tags is a list of (index in dictionary, reported ID) pairs.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = SYNTHETIC_SIZE
+    for _ in range(count):
+        # Smooth textured background
+        frame = cv.resize(rng.integers(60, 200, (h // 40, w // 40), dtype=np.uint8), (w, h),
+                          interpolation=cv.INTER_CUBIC)
+        markers = []
+        for index, tag_id in (tags[i] for i in rng.choice(len(tags), size=min(len(tags), 3), replace=False)):
+            size = rng.uniform(15, 300)
+            center = rng.uniform([size, size], [w - size, h - size])
+            square = np.float32([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size / 2
+            corners = np.float32(center + square + rng.normal(0, size * 0.08, (4, 2)))
+
+            # Marker with a white quiet zone, warped into place
+            image = cv.aruco.generateImageMarker(dictionary, int(index), 120, borderBits=1)
+            image = cv.copyMakeBorder(image, 20, 20, 20, 20, cv.BORDER_CONSTANT, value=255)
+            source = np.float32([[20, 20], [140, 20], [140, 140], [20, 140]])
+            H = cv.getPerspectiveTransform(source, corners)
+            warped = cv.warpPerspective(image, H, (w, h))
+            mask = cv.warpPerspective(np.full((160, 160), 255, np.uint8), H, (w, h))
+            frame[mask > 0] = warped[mask > 0]
+            markers.append({"id": int(tag_id), "corners": corners.tolist()})
+
+        frame = cv.GaussianBlur(frame, (0, 0), rng.uniform(0.3, 1.5))
+        frame = np.clip(frame + rng.normal(0, 3, frame.shape), 0, 255).astype(np.uint8)
+        yield frame, markers
+
+
+def recorded_frames(ground_truth_file):
+    ground_truth = json.loads(open(ground_truth_file, 'r').read())
+    base = os.path.dirname(ground_truth_file)
+    for entry in ground_truth["frames"]:
+        frame = cv.imread(os.path.join(base, entry["image"]), cv.IMREAD_GRAYSCALE)
+        if frame is None:
+            print("Failed to load", entry["image"])
+            continue
+        yield frame, entry["markers"]
+
+
+# Per-process state, set once by the pool initializer instead of being sent with every task
+_frames = None
+_dictionary = None
+_id_map = None
+
+
+def _init_worker(frames, pad_file):
+    global _frames, _dictionary, _id_map
+    # One thread per process, the pool provides the parallelism
+    cv.setNumThreads(1)
+    pad_config = load_pad_config(pad_file)
+    _frames = frames
+    _dictionary = pad_config.dictionary
+    _id_map = pad_config.id_map
+
+
+def evaluate(configuration):
+    """
+    Run one configuration over every frame, returns its configuration and measurements
+    """
+    detector = cv.aruco.ArucoDetector(_dictionary, detector_parameters(configuration))
+    latencies = []
+    found = expected = false_positives = 0
+    corner_errors = []
+
+    for frame, markers in _frames:
+        start = time.perf_counter()
+        corners, ids, _rejected = detector.detectMarkers(frame)
+        latencies.append(time.perf_counter() - start)
+
+        detections = []
+        if ids is not None:
+            ids = _id_map[ids] if _id_map is not None else ids
+            detections = [(int(i), np.reshape(c, (4, 2))) for i, c in zip(np.ravel(ids), corners)]
+
+        expected += len(markers)
+        matched = set()
+        for marker in markers:
+            truth = np.float32(marker["corners"])
+            for index, (tag_id, detected) in enumerate(detections):
+                error = np.linalg.norm(detected - truth, axis=1).mean()
+                if index not in matched and tag_id == marker["id"] and error < MATCH_DISTANCE:
+                    matched.add(index)
+                    corner_errors.append(error)
+                    found += 1
+                    break
+        false_positives += len(detections) - len(matched)
+
+    return {"detector_parameters": configuration,
+            "latency_ms": 1000 * float(np.mean(latencies)),
+            "latency_p95_ms": 1000 * float(np.percentile(latencies, 95)),
+            "detection_rate": found / max(expected, 1),
+            "false_positives_per_frame": false_positives / max(len(_frames), 1),
+            "corner_error_px": float(np.mean(corner_errors)) if corner_errors else None}
+
+
+def pareto_front(results):
+    """
+    Results no other result beats on both latency and detection rate, fastest first
+    """
+    front = []
+    for result in sorted(results, key=lambda r: (r["latency_ms"], -r["detection_rate"])):
+        if len(front) == 0 or result["detection_rate"] > front[-1]["detection_rate"]:
+            front.append(result)
+    return front
+
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], 'p:g:n:j:o:', ['max_fp='])
+    args = dict(args)
+    args.setdefault('-p', 'pad.json')
+    args.setdefault('-g', None)
+    args.setdefault('-n', 50)
+    args.setdefault('-j', os.cpu_count() or 1)
+    args.setdefault('-o', 'sweep.json')
+    args.setdefault('--max_fp', 0.05)
+
+    pad_file = str(args.get('-p'))
+    ground_truth_file = args.get('-g')
+    processes = int(args.get('-j'))
+    max_false_positives = float(args.get('--max_fp'))
+
+    pad_config = load_pad_config(pad_file)
+    if ground_truth_file:
+        frames = list(recorded_frames(ground_truth_file))
+    else:
+        # Synthetic markers are drawn from the pad's own dictionary, a restricted one holding id_map[i] at index i
+        if pad_config.id_map is not None:
+            tags = list(enumerate(pad_config.id_map))
+        else:
+            tags = [(int(tag_id), int(tag_id)) for tag_id in pad_config.pad_tags]
+        frames = list(synthetic_frames(pad_config.dictionary, tags, int(args.get('-n'))))
+
+    configurations = list(grid_configurations())
+    print("Sweeping %d configurations over %d frames with %d processes..." % (len(configurations), len(frames),
+                                                                              processes))
+    with Pool(processes, _init_worker, (frames, pad_file)) as pool:
+        results = pool.map(evaluate, configurations, chunksize=1)
+
+    # Configurations producing false positives are not worth their detection rate
+    acceptable = [r for r in results if r["false_positives_per_frame"] <= max_false_positives]
+    front = pareto_front(acceptable)
+
+    print("\n%10s %10s %10s %10s %10s" % ("latency", "p95", "detected", "false pos", "corner err"))
+    for result in front:
+        print("%8.2fms %8.2fms %9.1f%% %10.3f %8.2fpx" % (result["latency_ms"], result["latency_p95_ms"],
+                                                          100 * result["detection_rate"],
+                                                          result["false_positives_per_frame"],
+                                                          result["corner_error_px"] or 0.0))
+
+    with open(str(args.get('-o')), 'w') as f:
+        f.write(json.dumps({"pareto_front": front, "all": results}, indent=2))
+
+    if front:
+        print("\nBest detection rate, for the pad file:")
+        print(json.dumps({"detector_parameters": front[-1]["detector_parameters"]}, indent=2))
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    main()
@@ -0,0 +1,98 @@
+'''
+Tag pose estimation
+Keeps the pose of every tag from frame to frame to disambiguate and refine the next solve
+
+solvePnP with SOLVEPNP_IPPE_SQUARE has two solutions for a square tag, and picking the one with the lowest
+reprojection error flips between them when the tag is small. The estimator gets both candidates with
+solvePnPGeneric, keeps the one closest to the previous pose of the tag, and refines it with a few
+Levenberg-Marquardt iterations starting from that candidate. Without a recent previous pose (first sighting or
+track loss) the lowest error candidate is used.
+
+The uncertainty of a solved pose comes from the Jacobian of the projection of the tag corners: the covariance of
+(rvec, tvec) is sigma^2 (J^T J)^-1, sigma being the residual corner error (at least MIN_CORNER_SIGMA pixels, as four
+corners can fit a pose almost exactly). Small, far or oblique tags get a poorly conditioned J^T J and a large
+covariance.
+'''
+
+import numpy as np
+import cv2 as cv
+
+# Lowest corner localization error (pixels) assumed when estimating the pose covariance
+MIN_CORNER_SIGMA = 0.5
+
+
+def tag_object_points(marker_length):
+    """
+    Corners of a tag of side marker_length in the tag frame, in the order detectMarkers returns them
+    """
+    half = marker_length / 2
+    return np.array([
+        [-half, half, 0],
+        [half, half, 0],
+        [half, -half, 0],
+        [-half, -half, 0]
+    ], dtype=np.float32)
+
+
+def rotation_angle(rvec_a, rvec_b):
+    """
+    Angle in radians of the rotation between two Rodrigues vectors
+    """
+    R_a, _ = cv.Rodrigues(rvec_a)
+    R_b, _ = cv.Rodrigues(rvec_b)
+    cos_angle = (np.trace(R_a.T @ R_b) - 1) / 2
+    return float(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+
+
+def pose_covariance(obj_points, image_points, rvec, tvec, cam_matrix, dist_coefficients,
+                    min_sigma=MIN_CORNER_SIGMA):
+    """
+    RMS reprojection error (pixels) and 6x6 covariance of (rvec, tvec) of a solved pose
+    """
+    projected, jacobian = cv.projectPoints(obj_points, rvec, tvec, cam_matrix, dist_coefficients)
+    residuals = np.reshape(image_points, -1) - projected.reshape(-1)
+    squared = float(residuals @ residuals)
+    sigma_squared = max(squared / max(residuals.size - 6, 1), min_sigma ** 2)
+
+    # Columns of the rotation and translation, the others are the intrinsics
+    J = jacobian[:, :6]
+    return np.sqrt(squared / residuals.size), sigma_squared * np.linalg.pinv(J.T @ J)
+
+
+class PoseEstimator:
+    def __init__(self, max_age=0.25, max_rotation=0.5, refine_iterations=3):
+        # Previous poses older than max_age seconds are treated as a track loss
+        self.max_age = max_age
+        # Candidates further than max_rotation radians from the previous pose do not continue the track
+        self.max_rotation = max_rotation
+        self.criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, refine_iterations, 1e-6)
+
+        # tag id -> (time, rvec, tvec)
+        self.poses = {}
+
+    def solve(self, tag_id, obj_points, image_points, cam_matrix, dist_coefficients, now):
+        """
+        Pose (rvec, tvec) of a tag, each of shape (3, 1)
+        """
+        image_points = np.asarray(image_points, dtype=np.float32).reshape(-1, 1, 2)
+        count, rvecs, tvecs, errors = cv.solvePnPGeneric(obj_points, image_points, cam_matrix, dist_coefficients,
+                                                         flags=cv.SOLVEPNP_IPPE_SQUARE)
+
+        # Cold solve, lowest reprojection error first
+        best = int(np.argmin(np.ravel(errors)))
+
+        previous = self.poses.get(tag_id)
+        if previous is not None and now - previous[0] <= self.max_age:
+            angles = [rotation_angle(previous[1], rvec) for rvec in rvecs]
+            closest = int(np.argmin(angles))
+            if angles[closest] <= self.max_rotation:
+                best = closest
+
+        rvec, tvec = cv.solvePnPRefineLM(obj_points, image_points, cam_matrix, dist_coefficients,
+                                         rvecs[best].copy(), tvecs[best].copy(), criteria=self.criteria)
+
+        self.poses[tag_id] = (now, rvec, tvec)
+        return rvec, tvec
+
+    def reset(self):
+        self.poses = {}
@@ -0,0 +1,72 @@
+'''
+Scene change gate
+Tells whether a frame differs enough from the last processed one to be worth detecting tags in
+
+Each frame is reduced to a tiny thumbnail (decimated first, so the reduction only touches a fraction of the
+pixels) and compared to the thumbnail of the last frame that went through detection. A small tag barely moves the
+mean of a thumbnail, so the frame also counts as changed when any single thumbnail cell changed by more than
+cell_threshold, or when the region around any tag detected in the last processed frame changed by more than
+region_threshold at full resolution. Frames passing all three checks can reuse the previous detections, and a
+full pass is forced every max_skipped frames so the output never goes stale.
+'''
+
+import cv2 as cv
+
+# local modules
+from common import tag_bounds
+
+
+class SceneGate:
+    def __init__(self, threshold=2.0, max_skipped=30, size=(40, 32), decimation=8, cell_threshold=12.0,
+                 region_threshold=4.0, region_margin=0.5):
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.size = size
+        self.decimation = decimation
+        self.cell_threshold = cell_threshold
+        self.region_threshold = region_threshold
+        # The region of a tag is its bounding box grown by region_margin times its size
+        self.region_margin = region_margin
+
+        self.thumbnail = None
+        self.reference = None
+        self.skipped = 0
+        self.difference = None
+
+    def changed(self, gray, corners=()):
+        """
+        True if gray has to be processed, False if the previous results can be reused.
+        corners are the tags detected in the last processed frame.
+        """
+        thumbnail = cv.resize(gray[::self.decimation, ::self.decimation], self.size, interpolation=cv.INTER_AREA)
+
+        if self.thumbnail is not None and self.skipped < self.max_skipped and \
+                not self._changed(gray, thumbnail, corners):
+            self.skipped += 1
+            return False
+
+        self.thumbnail = thumbnail
+        self.reference = gray
+        self.skipped = 0
+        return True
+
+    def _changed(self, gray, thumbnail, corners):
+        difference = cv.absdiff(thumbnail, self.thumbnail)
+        self.difference = cv.norm(difference, cv.NORM_L1) / thumbnail.size
+        if self.difference >= self.threshold or difference.max() > self.cell_threshold:
+            return True
+
+        for tag_corners in corners:
+            bounds = tag_bounds([tag_corners], self.region_margin, gray.shape)
+            if bounds is None:
+                continue
+            x0, y0, x1, y1 = bounds
+            region = gray[y0:y1, x0:x1]
+            if cv.norm(region, self.reference[y0:y1, x0:x1], cv.NORM_L1) / region.size > self.region_threshold:
+                return True
+        return False
+
+    def reset(self):
+        self.thumbnail = None
+        self.reference = None
+        self.skipped = 0
@@ -0,0 +1,143 @@
+'''
+systemd watchdog
+sd_notify over the NOTIFY_SOCKET datagram protocol, with per-stage stall detection
+
+Each stage of the pipeline (capture and detection of every camera, MAVLink send) reports its progress. READY=1 is
+sent once every stage has made progress once, and WATCHDOG=1 pings are only sent while every stage has made
+progress within its deadline, so systemd restarts the service when any of them stalls.
+Without NOTIFY_SOCKET (not started by systemd) nothing is sent.
+
+usage:
+    sd_watchdog.py [-l <socket path>]
+
+listens on a datagram socket and prints what is sent to it, to stand in for systemd:
+    sd_watchdog.py -l /tmp/notify &
+    NOTIFY_SOCKET=/tmp/notify WATCHDOG_USEC=5000000 main.py ...
+
+default values:
+    -l: /tmp/notify
+'''
+
+import os
+import sys
+import getopt
+import socket
+import threading
+import time
+
+# Deadlines (seconds) of the stages, camera stages are prefixed with the camera name
+DEFAULT_DEADLINES = {"capture": 2.0, "detect": 2.0, "send": 2.0}
+
+
+class Notifier:
+    def __init__(self, socket_path=None):
+        socket_path = socket_path if socket_path is not None else os.environ.get("NOTIFY_SOCKET")
+        self.sock = None
+        if socket_path:
+            # Abstract namespace sockets are given with a leading @
+            if socket_path.startswith("@"):
+                socket_path = "\0" + socket_path[1:]
+            self.address = socket_path
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    @property
+    def enabled(self):
+        return self.sock is not None
+
+    def notify(self, message):
+        """
+        Send a state message such as READY=1, returns False if it could not be sent
+        """
+        if self.sock is None:
+            return False
+        try:
+            self.sock.sendto(message.encode(), self.address)
+            return True
+        except OSError:
+            return False
+
+
+def parse_deadlines(text):
+    """
+    Parse a "stage:seconds,stage:seconds" list into a dict of deadlines, starting from the defaults
+    """
+    deadlines = dict(DEFAULT_DEADLINES)
+    for item in filter(None, text.split(",")):
+        stage, seconds = item.split(":")
+        deadlines[stage.strip()] = float(seconds)
+    return deadlines
+
+
+class Watchdog:
+    def __init__(self, deadlines=DEFAULT_DEADLINES, notifier=None, watchdog_usec=None, log=print):
+        self.deadlines = deadlines
+        self.notifier = notifier if notifier is not None else Notifier()
+        self.log = log
+
+        # Ping twice per watchdog period, as sd_watchdog_enabled() users do
+        watchdog_usec = watchdog_usec if watchdog_usec is not None else int(os.environ.get("WATCHDOG_USEC", 0))
+        self.ping_interval = watchdog_usec / 2e6 if watchdog_usec else None
+
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.ready = False
+        self.last_ping = None
+        self.stalled = []
+
+    def add_stage(self, stage, kind=None):
+        """
+        Register a stage, its deadline is the one of its kind (the stage name by default)
+        """
+        with self.lock:
+            self.stages[stage] = [self.deadlines[kind or stage], None]
+
+    def progress(self, stage, now=None):
+        self.stages[stage][1] = time.monotonic() if now is None else now
+
+    def update(self, now=None):
+        """
+        Send READY and WATCHDOG messages as due, returns the list of stalled stages
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            stages = list(self.stages.items())
+
+        if not self.ready:
+            if all(last is not None for stage, (deadline, last) in stages):
+                self.ready = True
+                self.notifier.notify("READY=1")
+            return []
+
+        stalled = [stage for stage, (deadline, last) in stages if now - last > deadline]
+        if stalled != self.stalled:
+            self.stalled = stalled
+            status = "stalled: " + ", ".join(stalled) if stalled else "running"
+            self.notifier.notify("STATUS=" + status)
+            self.log("watchdog: " + status)
+
+        if len(stalled) == 0 and self.ping_interval is not None and \
+                (self.last_ping is None or now - self.last_ping >= self.ping_interval):
+            self.last_ping = now
+            self.notifier.notify("WATCHDOG=1")
+        return stalled
+
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], 'l:', [])
+    args = dict(args)
+    args.setdefault('-l', '/tmp/notify')
+
+    path = args.get('-l')
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    start = time.monotonic()
+    while True:
+        message = sock.recv(4096).decode()
+        print("%8.3f %s" % (time.monotonic() - start, message))
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    main()
@@ -0,0 +1,191 @@
+'''
+Target tracking
+Keeps a filtered track of every pad and selects the one to land on
+
+Every pad of the pad set is a target, its track being the row of the pad in the track arrays. A batch of
+measurements from every camera updates all the tracks it concerns with a few numpy operations, whatever the number
+of pads in view. Measurements are associated to tracks by pad (tag IDs are unique across pads): the measurements of a
+pad are averaged and gated against the prediction of its track. One outside the gate is dropped as a mismatch (a pose
+flip, a tag decoded wrong), unless the track keeps missing, in which case the track restarts from the measurement.
+Tracks are constant velocity alpha-beta filters.
+Measurements with a covariance are weighted by the inverse of its trace (the position variance): uncertain ones
+count less in the average, move the track less, and widen the gate by 3 standard deviations.
+
+The target sent to the autopilot is picked by a selection policy:
+    closest: the nearest tracked pad, only switching to another pad once it is clearly closer
+    <payload tag ID>: the pad with that payload tag
+    mavlink: the pad commanded with a COMMAND_LONG MAV_CMD_USER_1, param1 being its payload tag ID (-1 for the
+             closest)
+'''
+
+import numpy as np
+
+# Measurements closer together than this (seconds) do not update the velocity
+MIN_VELOCITY_DT = 0.005
+
+
+class TargetTracker:
+    def __init__(self, pad_count, alpha=0.7, beta=0.2, gate=0.5, gate_ratio=0.1, max_misses=3, max_age=0.5,
+                 nominal_variance=0.01):
+        # Filter gains of the position and velocity, for a measurement variance (square meters) well under
+        # nominal_variance. A measurement of variance nominal_variance gets half of them.
+        self.alpha = alpha
+        self.beta = beta
+        self.nominal_variance = nominal_variance
+        # Measurements further than gate meters plus gate_ratio of the distance from the prediction are mismatches
+        self.gate = gate
+        self.gate_ratio = gate_ratio
+        # A track restarts after max_misses mismatches in a row, or without a measurement for max_age seconds
+        self.max_misses = max_misses
+        self.max_age = max_age
+
+        self.position = np.zeros((pad_count, 3))
+        self.velocity = np.zeros((pad_count, 3))
+        self.time = np.full(pad_count, -np.inf)
+        self.misses = np.zeros(pad_count, dtype=np.int32)
+        # Variance of the last measurement of every track, square meters
+        self.variance = np.zeros(pad_count)
+
+    def update(self, pads, times, positions, covariances=None):
+        """
+        Update the tracks with a batch of measurements, pads holding the pad index of every measurement and
+        covariances their 3x3 covariance (or None).
+        Returns the pad indices of the tracks updated, and the number of measurements rejected by the gate.
+        """
+        pads = np.asarray(pads, dtype=np.intp)
+        rows, inverse, counts = np.unique(pads, return_inverse=True, return_counts=True)
+
+        # Inverse variance weighted average of the measurements of every pad
+        variances = np.zeros(len(pads))
+        if covariances is not None:
+            variances = np.array([0.0 if covariance is None else np.trace(covariance) for covariance in covariances])
+        weights = 1.0 / (variances + 1e-9)
+        weight_sums = np.zeros(len(rows))
+        np.add.at(weight_sums, inverse, weights)
+        measured = np.zeros((len(rows), 3))
+        np.add.at(measured, inverse, weights[:, None] * np.asarray(positions, dtype=np.float64).reshape(-1, 3))
+        measured /= weight_sums[:, None]
+        variance = np.maximum(1.0 / weight_sums - 1e-9, 0.0)
+        measured_time = np.full(len(rows), -np.inf)
+        np.maximum.at(measured_time, inverse, np.asarray(times, dtype=np.float64))
+
+        # Measurements older than the track (another camera lagging behind) are taken as current
+        dt = np.maximum(measured_time - self.time[rows], 0.0)
+        lost = dt > self.max_age
+        predicted = self.position[rows] + self.velocity[rows] * np.where(lost, 0.0, dt)[:, None]
+        residual = measured - predicted
+        gate = self.gate + self.gate_ratio * np.linalg.norm(predicted, axis=1) + 3 * np.sqrt(variance)
+        miss = ~lost & (np.linalg.norm(residual, axis=1) > gate)
+
+        misses = np.where(miss, self.misses[rows] + 1, 0)
+        restart = lost | (misses > self.max_misses)
+        accepted = ~miss
+
+        # Filter the associated tracks, restart the lost ones from their measurement
+        confidence = (self.nominal_variance / (self.nominal_variance + variance))[:, None]
+        position = predicted + self.alpha * confidence * residual
+        velocity = self.velocity[rows] + confidence * np.where(
+            dt > MIN_VELOCITY_DT, self.beta / np.maximum(dt, MIN_VELOCITY_DT), 0.0)[:, None] * residual
+        position[restart] = measured[restart]
+        velocity[restart] = 0.0
+        misses[restart] = 0
+
+        update = accepted | restart
+        self.position[rows[update]] = position[update]
+        self.velocity[rows[update]] = velocity[update]
+        self.time[rows[update]] = np.maximum(self.time[rows[update]], measured_time[update])
+        self.variance[rows[update]] = variance[update]
+        self.misses[rows] = misses
+        return rows[update], int(counts[~update].sum())
+
+    def refresh(self, pads, times):
+        """
+        Bring the time of the given tracks forward without a new measurement, for a scene known to be unchanged.
+        Lost tracks stay lost. Returns the pad indices of the tracks refreshed.
+        """
+        pads = np.asarray(pads, dtype=np.intp)
+        times = np.asarray(times, dtype=np.float64)
+        current = times - self.time[pads] <= self.max_age
+        np.maximum.at(self.time, pads[current], times[current])
+        return np.unique(pads[current])
+
+    def fresh(self, now):
+        """
+        Mask of the tracks updated within max_age seconds
+        """
+        return now - self.time <= self.max_age
+
+    def reset(self):
+        self.time[:] = -np.inf
+        self.misses[:] = 0
+
+
+class TargetSelector:
+    def __init__(self, payload_ids, policy="closest", switch_margin=0.2):
+        """
+        payload_ids holds the payload tag ID of every pad. policy is "closest", "mavlink" or a payload tag ID.
+        The closest policy only leaves the selected pad for one switch_margin closer.
+        """
+        self.payload_ids = list(payload_ids)
+        self.policy = policy if policy in ("closest", "mavlink") else int(policy)
+        if self.policy not in ("closest", "mavlink") and self.policy not in self.payload_ids:
+            raise ValueError("no pad has the payload tag %d" % self.policy)
+        self.switch_margin = switch_margin
+        # Payload tag ID commanded over MAVLink, None for the closest
+        self.commanded = None
+        self.selected = None
+
+    def command(self, payload_id):
+        """
+        Select the pad with the given payload tag ID, or the closest for -1.
+        Returns False if commands are not accepted or there is no such pad.
+        """
+        if self.policy != "mavlink" or (payload_id != -1 and payload_id not in self.payload_ids):
+            return False
+        self.commanded = None if payload_id == -1 else payload_id
+        return True
+
+    def wanted(self):
+        """
+        Payload tag ID the policy asks for, None for the closest
+        """
+        payload_id = self.commanded if self.policy == "mavlink" else self.policy
+        return None if payload_id == "closest" else payload_id
+
+    def select(self, tracker, now):
+        """
+        Index of the pad to send, None if it is not tracked
+        """
+        fresh = tracker.fresh(now)
+        payload_id = self.wanted()
+        if payload_id is not None:
+            # The pad may have been edited away
+            if payload_id not in self.payload_ids:
+                return None
+            self.selected = self.payload_ids.index(payload_id)
+            return self.selected if fresh[self.selected] else None
+
+        distances = np.where(fresh, np.linalg.norm(tracker.position, axis=1), np.inf)
+        best = int(np.argmin(distances))
+        if not np.isfinite(distances[best]):
+            return None
+        if self.selected is not None and fresh[self.selected] and \
+                distances[best] > (1 - self.switch_margin) * distances[self.selected]:
+            best = self.selected
+        self.selected = best
+        return best
+
+    def select_bearing(self, bearings):
+        """
+        Pad to send the bearing of, among a dict of pad index -> unit line of sight. Without a wanted or previously
+        selected pad in view, the pad closest to straight below.
+        """
+        payload_id = self.wanted()
+        if payload_id is not None:
+            pad = self.payload_ids.index(payload_id) if payload_id in self.payload_ids else None
+            return pad if pad in bearings else None
+        if self.selected in bearings:
+            return self.selected
+        if len(bearings) == 0:
+            return None
+        return max(bearings, key=lambda pad: bearings[pad][2])
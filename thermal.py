@@ -0,0 +1,174 @@
+'''
+Thermal workload scheduling
+Degrades the detection workload as the CM4 heats up, before the firmware throttles the CPU
+
+The SoC temperature and CPU frequency are read from sysfs at most once per period, and mapped to a workload level
+with hysteresis. Each level is a profile the camera workers follow:
+    detection_interval: multiplier of the frames between two full detections
+    roi_margin:         if set, full detection only looks around the last known tags, grown by this times their size
+    downscale:          full detection runs on frames downscaled by this factor
+    max_workers:        if set, only the first max_workers cameras keep processing
+Firmware throttling already under way raises the level by one. It is read from the firmware throttle flags (capped
+ARM frequency, throttling or soft temperature limit active now). Without them, a CPU running under its maximum
+frequency counts as throttled only with the performance governor, as other governors lower the clock when idle.
+
+usage:
+    thermal.py [-r <sysfs root>]
+
+prints the temperature, frequency and workload level, a fake sysfs tree can be used for testing:
+    <root>/class/thermal/thermal_zone0/temp                       millidegrees Celsius
+    <root>/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq       kHz
+    <root>/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq       kHz
+    <root>/devices/system/cpu/cpu0/cpufreq/scaling_governor       e.g. performance
+    <root>/devices/platform/soc/soc:firmware/get_throttled        hexadecimal throttle flags
+
+default values:
+    -r: /sys
+'''
+
+import os
+import sys
+import getopt
+import time
+
+# local modules
+from common import Bunch
+
+WORKLOAD_LEVELS = [
+    Bunch(detection_interval=1, roi_margin=None, downscale=1, max_workers=None),
+    Bunch(detection_interval=2, roi_margin=None, downscale=1, max_workers=None),
+    Bunch(detection_interval=2, roi_margin=1.0, downscale=1, max_workers=None),
+    Bunch(detection_interval=4, roi_margin=0.5, downscale=2, max_workers=None),
+    Bunch(detection_interval=4, roi_margin=0.5, downscale=2, max_workers=1),
+]
+
+# Temperatures (degrees Celsius) at which levels 1, 2, 3 and 4 are entered, below the 80-85 degree firmware limits
+LEVEL_TEMPERATURES = [65.0, 70.0, 75.0, 78.0]
+
+# Firmware throttle flags of what is happening now: ARM frequency capped, throttled, soft temperature limit active
+THROTTLED_NOW = 0x2 | 0x4 | 0x8
+
+
+def read_sysfs_int(path, base=10):
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip(), base)
+    except (OSError, ValueError):
+        return None
+
+
+def read_sysfs_str(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class ThermalMonitor:
+    """
+    Cached temperature, CPU frequency and firmware throttle flag readings, the files are read at most once per period
+    seconds
+    """
+    def __init__(self, sysfs_root='/sys', zone='thermal_zone0', cpu='cpu0', period=1.0):
+        self.temp_path = os.path.join(sysfs_root, 'class', 'thermal', zone, 'temp')
+        cpufreq = os.path.join(sysfs_root, 'devices', 'system', 'cpu', cpu, 'cpufreq')
+        self.freq_path = os.path.join(cpufreq, 'scaling_cur_freq')
+        self.max_freq = read_sysfs_int(os.path.join(cpufreq, 'cpuinfo_max_freq'))
+        self.governor_path = os.path.join(cpufreq, 'scaling_governor')
+        self.flags_path = os.path.join(sysfs_root, 'devices', 'platform', 'soc', 'soc:firmware', 'get_throttled')
+        self.period = period
+
+        self.last_read = None
+        self.temperature = None
+        self.frequency = None
+        self.governor = None
+        self.flags = None
+
+    def read(self, now=None):
+        """
+        Returns (temperature in degrees Celsius, frequency in kHz), either can be None if unavailable
+        """
+        now = time.monotonic() if now is None else now
+        if self.last_read is None or now - self.last_read >= self.period:
+            self.last_read = now
+            millidegrees = read_sysfs_int(self.temp_path)
+            self.temperature = None if millidegrees is None else millidegrees / 1000.0
+            self.frequency = read_sysfs_int(self.freq_path)
+            self.governor = read_sysfs_str(self.governor_path)
+            self.flags = read_sysfs_int(self.flags_path, 16)
+        return self.temperature, self.frequency
+
+    def throttled(self):
+        """
+        True if the firmware is throttling the CPU now. Without its flags, a reduced frequency is only trusted with the
+        performance governor.
+        """
+        if self.flags is not None:
+            return self.flags & THROTTLED_NOW != 0
+        return self.governor == 'performance' and self.frequency is not None and self.max_freq is not None and \
+            self.frequency < 0.95 * self.max_freq
+
+
+class ThermalScheduler:
+    """
+    Maps the temperature to a workload level, a level is only left once the temperature is hysteresis degrees
+    under the temperature it was entered at.
+    """
+    def __init__(self, monitor, levels=WORKLOAD_LEVELS, temperatures=LEVEL_TEMPERATURES, hysteresis=3.0, log=print):
+        self.monitor = monitor
+        self.levels = levels
+        self.temperatures = temperatures
+        self.hysteresis = hysteresis
+        self.log = log
+        self.level = 0
+        self.thermal_level = 0
+
+    @property
+    def profile(self):
+        return self.levels[self.level]
+
+    def update(self, now=None):
+        """
+        Read the sensors if due and update the level, returns the current profile
+        """
+        temperature, frequency = self.monitor.read(now)
+        if temperature is None:
+            return self.profile
+
+        # Climb to every level whose temperature is reached, step down only past the hysteresis
+        level = self.thermal_level
+        while level < len(self.temperatures) and temperature >= self.temperatures[level]:
+            level += 1
+        while level > 0 and temperature < self.temperatures[level - 1] - self.hysteresis:
+            level -= 1
+        self.thermal_level = level
+
+        if self.monitor.throttled():
+            level = min(level + 1, len(self.levels) - 1)
+
+        if level != self.level:
+            self.log("thermal: %.1f C, %s kHz -> workload level %d" % (temperature, frequency, level))
+            self.level = level
+        return self.profile
+
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], 'r:', [])
+    args = dict(args)
+    args.setdefault('-r', '/sys')
+
+    scheduler = ThermalScheduler(ThermalMonitor(args.get('-r')))
+    profile = scheduler.update()
+    temperature, frequency = scheduler.monitor.read()
+    monitor = scheduler.monitor
+    print("temperature: %s C, frequency: %s kHz (max %s kHz, %s governor)" % (temperature, frequency, monitor.max_freq,
+                                                                          monitor.governor))
+    print("throttle flags: %s, throttled: %s" % (None if monitor.flags is None else hex(monitor.flags),
+                                                monitor.throttled()))
+    print("workload level %d: %s" % (scheduler.level, profile))
+
+
+if __name__ == '__main__':
+    print(__doc__)
+    main()
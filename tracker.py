@@ -0,0 +1,116 @@
+'''
+Tag corner tracking
+Propagates the corners of detected aruco tags between full detections with pyramidal Lucas-Kanade optical flow
+
+Full detection is run every redetect_interval frames, or on the frame after any track was lost, so a tag whose
+track fails is not left out until the next scheduled detection. In between, the four
+corners of each tag are tracked on a small patch around the tag, and a track is only kept if it passes a
+forward-backward error check and still looks like a tag (convex quad of plausible area).
+'''
+
+import numpy as np
+import cv2 as cv
+
+
+class CornerTracker:
+    def __init__(self, redetect_interval=5, win_size=(15, 15), max_level=2, fb_threshold=1.0,
+                 min_area=64.0, max_area_change=1.5):
+        self.redetect_interval = redetect_interval
+        self.win_size = win_size
+        self.max_level = max_level
+        self.fb_threshold = fb_threshold
+        self.min_area = min_area
+        self.max_area_change = max_area_change
+
+        self.lk_params = dict(winSize=win_size,
+                              maxLevel=max_level,
+                              criteria=(cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 10, 0.03))
+
+        # Pixels around the tag included in its patch, enough for the window at the coarsest pyramid level
+        self.margin = max(win_size) * (2 ** max_level)
+
+        self.prev_gray = None
+        self.corners = []
+        self.ids = []
+        self.frames_since_detection = 0
+        # A track was dropped since the last detection
+        self.lost = False
+
+    def need_detection(self):
+        """
+        True when the next frame should go through full detection
+        """
+        return len(self.ids) == 0 or self.lost or self.frames_since_detection >= self.redetect_interval - 1
+
+    def update_detection(self, gray, corners, ids):
+        """
+        Restart the tracks from the output of detectMarkers
+        """
+        self.prev_gray = gray
+        self.frames_since_detection = 0
+        self.lost = False
+        if ids is None:
+            self.corners, self.ids = [], []
+        else:
+            self.corners = [np.float32(c).reshape(4, 2) for c in corners]
+            self.ids = [int(i) for i in np.ravel(ids)]
+
+    def reset(self):
+        self.prev_gray = None
+        self.corners, self.ids = [], []
+        self.lost = False
+
+    def track(self, gray):
+        """
+        Track the tags into gray, returns (corners, ids) in the detectMarkers format, ids is None if every track was lost
+        """
+        corners, ids = [], []
+        for quad, tag_id in zip(self.corners, self.ids):
+            new_quad = self._track_quad(self.prev_gray, gray, quad)
+            if new_quad is not None:
+                corners.append(new_quad)
+                ids.append(tag_id)
+
+        self.prev_gray = gray
+        self.lost = self.lost or len(ids) < len(self.ids)
+        self.corners, self.ids = corners, ids
+        self.frames_since_detection += 1
+
+        if len(ids) == 0:
+            return (), None
+        return tuple(c.reshape(1, 4, 2) for c in corners), np.array(ids, dtype=np.int32).reshape(-1, 1)
+
+    def _track_quad(self, prev_gray, gray, quad):
+        # Only build the pyramids of a patch around the tag
+        h, w = gray.shape[:2]
+        x0, y0 = np.maximum(np.floor(quad.min(0)) - self.margin, 0).astype(int)
+        x1, y1 = np.minimum(np.ceil(quad.max(0)) + self.margin, (w, h)).astype(int)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        offset = np.float32([x0, y0])
+        prev_patch = prev_gray[y0:y1, x0:x1]
+        patch = gray[y0:y1, x0:x1]
+
+        p0 = (quad - offset).reshape(-1, 1, 2)
+        p1, st, _err = cv.calcOpticalFlowPyrLK(prev_patch, patch, p0, None, **self.lk_params)
+        p0r, st_back, _err = cv.calcOpticalFlowPyrLK(patch, prev_patch, p1, None, **self.lk_params)
+
+        # Forward-backward check, every corner has to come back where it started
+        fb_error = np.abs(p0 - p0r).reshape(-1, 2).max(-1)
+        if not (st.all() and st_back.all() and (fb_error < self.fb_threshold).all()):
+            return None
+
+        new_quad = p1.reshape(4, 2) + offset
+        if not self._plausible_quad(quad, new_quad):
+            return None
+        return new_quad
+
+    def _plausible_quad(self, quad, new_quad):
+        if not cv.isContourConvex(new_quad.reshape(-1, 1, 2)):
+            return False
+        area = cv.contourArea(new_quad)
+        prev_area = cv.contourArea(quad)
+        if area < self.min_area or prev_area <= 0:
+            return False
+        change = area / prev_area
+        return 1.0 / self.max_area_change <= change <= self.max_area_change